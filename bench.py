@@ -0,0 +1,374 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Offline benchmark of the HTTP server and transfer engine. MTProtoSender and the Telegram client
+# are replaced by local stand-ins that serve synthetic files, so no Telegram account is needed.
+#
+#   python3 bench.py --concurrency 1,8,32 --duration 10 --latency 80 --json bench_output.json
+#
+# Configuration environment variables (DOWNLOAD_PREFETCH, MEMORY_CACHE_SIZE, ...) apply as usual.
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+os.environ.setdefault('TG_API_ID', '1')
+os.environ.setdefault('TG_API_HASH', 'benchmark')
+os.environ.setdefault('TG_BOT_TOKEN', '1:benchmark')
+# Every benchmark client comes from the same address
+os.environ.setdefault('REQUEST_LIMIT', '1000000')
+os.environ.setdefault('MIN_CONNECTIONS', '0')
+
+import aiohttp
+from aiohttp import web
+from telethon import errors
+from telethon.crypto import AuthKey
+from telethon.tl.types import Document, DocumentAttributeFilename, MessageMediaDocument
+
+root = os.path.dirname(os.path.abspath(__file__))
+chunk_pool = os.urandom(1024 * 1024)
+
+
+class FakeResult:
+    def __init__(self, data: bytes) -> None:
+        self.bytes = data
+
+
+class FakeConfig:
+    latency: float = 0.05
+    jitter: float = 0.02
+    bandwidth: float = 20 * 1024 * 1024
+    error_rate: float = 0
+    flood_rate: float = 0
+    flood_seconds: int = 1
+    api_latency: float = 0.1
+    file_sizes: Dict[int, int] = {}
+
+
+# Stands in for MTProtoSender. Every connection has its own bandwidth, so responses queue up
+# behind each other like they would on a real TCP connection.
+class FakeSender:
+    def __init__(self, auth_key, loop, *, loggers, auth_key_callback=None) -> None:
+        self.auth_key = auth_key or AuthKey(os.urandom(256))
+        self._busy_until = 0.0
+
+    async def connect(self, connection) -> None:
+        await asyncio.sleep(FakeConfig.latency * 3)
+
+    async def disconnect(self) -> None:
+        pass
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def send(self, request):
+        latency = FakeConfig.latency + random.uniform(0, FakeConfig.jitter)
+        if not hasattr(request, 'offset'):
+            await asyncio.sleep(latency)
+            return None
+        if random.random() < FakeConfig.flood_rate:
+            await asyncio.sleep(latency)
+            raise errors.FloodWaitError(request, capture=FakeConfig.flood_seconds)
+        if random.random() < FakeConfig.error_rate:
+            await asyncio.sleep(latency)
+            raise errors.ServerError(request, 'INTERNAL')
+        size = FakeConfig.file_sizes.get(request.location.id, 0)
+        length = max(min(request.limit, size - request.offset), 0)
+        now = time.monotonic()
+        start = max(now + latency, self._busy_until)
+        self._busy_until = start + length / FakeConfig.bandwidth
+        await asyncio.sleep(self._busy_until - now)
+        # Requests never cross a 1 MiB boundary, so the slice always fits in the pool
+        pool_offset = request.offset % len(chunk_pool)
+        return FakeResult(chunk_pool[pool_offset:pool_offset + length])
+
+
+class FakeFile:
+    def __init__(self, name: str, size: int, mime_type: str) -> None:
+        self.name = name
+        self.size = size
+        self.mime_type = mime_type
+        self.ext = os.path.splitext(name)[1]
+
+
+class FakeMessage:
+    def __init__(self, msg_id: int, chat_id: int, size: int) -> None:
+        self.id = msg_id
+        self.chat_id = chat_id
+        self.date = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        name = f'bench{msg_id}.mp4'
+        self.file = FakeFile(name, size, 'video/mp4')
+        self.media = MessageMediaDocument(document=Document(
+            id=msg_id, access_hash=0, file_reference=b'', date=self.date, mime_type='video/mp4',
+            size=size, dc_id=2, attributes=[DocumentAttributeFilename(name)]))
+
+
+class FakeDC:
+    def __init__(self, dc_id: int) -> None:
+        self.id = dc_id
+        self.ip_address = '127.0.0.1'
+        self.port = 443
+
+
+class FakeSession:
+    dc_id = 2
+    auth_key = AuthKey(os.urandom(256))
+    server_address = '127.0.0.1'
+
+
+class FakeAuthorization:
+    id = 1
+    bytes = b'benchmark'
+
+
+# Stands in for the TelegramClient as far as the transfer engine and web routes use it
+class FakeClient:
+    def __init__(self, loop: asyncio.AbstractEventLoop, messages: Dict[int, FakeMessage]) -> None:
+        self.loop = loop
+        self.messages = messages
+        self.session = FakeSession()
+        self._log = None
+        self._proxy = None
+
+    async def _get_dc(self, dc_id: int) -> FakeDC:
+        return FakeDC(dc_id)
+
+    def _connection(self, *args, **kwargs) -> None:
+        return None
+
+    def _init_with(self, request):
+        return request
+
+    async def __call__(self, request) -> FakeAuthorization:
+        await asyncio.sleep(FakeConfig.api_latency)
+        return FakeAuthorization()
+
+    async def get_messages(self, entity, ids: int) -> Optional[FakeMessage]:
+        await asyncio.sleep(FakeConfig.api_latency)
+        return self.messages.get(ids)
+
+    async def get_me(self):
+        return None
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.requests = 0
+        self.failures = 0
+        self.ttfb: List[float] = []
+        self.latency: List[float] = []
+
+
+async def run_client(session: aiohttp.ClientSession, base_url: str, links: List[str],
+                     sizes: List[int], range_ratio: float, deadline: float, stats: Stats) -> None:
+    while time.monotonic() < deadline:
+        index = random.randrange(len(links))
+        headers = {}
+        if random.random() < range_ratio:
+            size = sizes[index]
+            length = min(random.randint(64 * 1024, 2 * 1024 * 1024), size)
+            start = random.randint(0, size - length)
+            headers['Range'] = f'bytes={start}-{start + length - 1}'
+        started = time.monotonic()
+        first_byte: Optional[float] = None
+        try:
+            async with session.get(base_url + links[index], headers=headers) as resp:
+                if resp.status not in (200, 206):
+                    stats.failures += 1
+                    continue
+                async for chunk in resp.content.iter_any():
+                    if first_byte is None:
+                        first_byte = time.monotonic()
+                    stats.bytes += len(chunk)
+        except aiohttp.ClientError:
+            stats.failures += 1
+            continue
+        stats.requests += 1
+        stats.ttfb.append((first_byte or time.monotonic()) - started)
+        stats.latency.append(time.monotonic() - started)
+
+
+async def run_level(base_url: str, links: List[str], sizes: List[int], concurrency: int,
+                    duration: float, range_ratio: float) -> Dict[str, float]:
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + duration
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[run_client(session, base_url, links, sizes, range_ratio, deadline,
+                                          stats)
+                               for _ in range(concurrency)])
+    elapsed = time.monotonic() - started
+    return {
+        'concurrency': concurrency,
+        'requests': stats.requests,
+        'failures': stats.failures,
+        'throughput_mib_s': stats.bytes / elapsed / 1024 / 1024,
+        'ttfb_p50_ms': percentile(stats.ttfb, 0.5) * 1000,
+        'ttfb_p99_ms': percentile(stats.ttfb, 0.99) * 1000,
+        'latency_p50_ms': percentile(stats.latency, 0.5) * 1000,
+        'latency_p99_ms': percentile(stats.latency, 0.99) * 1000,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# Runs one concurrency level against a server in this process
+async def serve_level(args: argparse.Namespace) -> Dict[str, float]:
+    FakeConfig.latency = args.latency / 1000
+    FakeConfig.jitter = args.jitter / 1000
+    FakeConfig.bandwidth = args.bandwidth * 1024 * 1024
+    FakeConfig.error_rate = args.error_rate
+    FakeConfig.flood_rate = args.flood_rate
+    FakeConfig.flood_seconds = args.flood_seconds
+    FakeConfig.api_latency = args.api_latency / 1000
+
+    # The modules below create the Telegram client and its session file at import time
+    os.chdir(tempfile.mkdtemp(prefix='tgfilestream-bench-'))
+    sys.path.insert(0, root)
+
+    from tgfilestream import paralleltransfer
+    paralleltransfer.MTProtoSender = FakeSender
+
+    loop = asyncio.get_event_loop()
+    messages = {}
+    for msg_id in range(1, args.files + 1):
+        messages[msg_id] = FakeMessage(msg_id, args.chat_id, args.file_size * 1024 * 1024)
+        FakeConfig.file_sizes[msg_id] = messages[msg_id].file.size
+    client = FakeClient(loop, messages)
+
+    from tgfilestream import telegram
+    from tgfilestream.metacache import FileMetaCache
+    from tgfilestream.peercache import PeerCache
+    telegram.transfer = paralleltransfer.ParallelTransferrer(client)
+    telegram.peers = PeerCache(client)
+    telegram.meta_cache = FileMetaCache(client, telegram.peers)
+    from tgfilestream.metrics import metrics_middleware
+    from tgfilestream import linkid
+    from tgfilestream.web_routes import routes, ready_middleware
+
+    telegram.transfer.post_init()
+    telegram.client_ready.set()
+    links = [f'/{linkid.encode(args.chat_id, msg.id)}/{msg.file.name}'
+             for msg in messages.values()]
+    sizes = [msg.file.size for msg in messages.values()]
+
+    server = web.Application(middlewares=[metrics_middleware, ready_middleware])
+    server.add_routes(routes)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    base_url = f'http://127.0.0.1:{args.port}'
+
+    result = await run_level(base_url, links, sizes, args.level, args.duration, args.range_ratio)
+
+    await runner.cleanup()
+    await telegram.transfer.stop()
+    return result
+
+
+# Every level runs in a new process, so the peak RSS is that level's alone and no level starts
+# with the caches the previous one filled
+def run_level_process(concurrency: int) -> Dict[str, float]:
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                                      '--level', str(concurrency)])
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.level:
+        result = asyncio.get_event_loop().run_until_complete(serve_level(args))
+        print(json.dumps(result))
+        return
+
+    output = os.path.abspath(args.json) if args.json else None
+    results = []
+    print(f'{"clients":>8} {"reqs":>7} {"fail":>5} {"MiB/s":>9} {"ttfb p50":>9} {"ttfb p99":>9}'
+          f' {"p50 ms":>9} {"p99 ms":>9} {"rss MiB":>8}')
+    for concurrency in args.concurrency:
+        result = run_level_process(concurrency)
+        results.append(result)
+        print(f'{result["concurrency"]:>8} {result["requests"]:>7} {result["failures"]:>5}'
+              f' {result["throughput_mib_s"]:>9.2f} {result["ttfb_p50_ms"]:>9.1f}'
+              f' {result["ttfb_p99_ms"]:>9.1f} {result["latency_p50_ms"]:>9.1f}'
+              f' {result["latency_p99_ms"]:>9.1f} {result["peak_rss_mib"]:>8.1f}')
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({
+                'revision': args.revision or git_revision(),
+                'parameters': {key: value for key, value in vars(args).items()
+                               if key not in ('json', 'revision', 'level')},
+                'results': results,
+            }, file, indent=2)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark tgfilestream against a fake Telegram')
+    parser.add_argument('--concurrency', type=lambda value: [int(x) for x in value.split(',')],
+                        default=[1, 8, 32], help='comma-separated client counts to run')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+    parser.add_argument('--files', type=int, default=8, help='number of distinct files')
+    parser.add_argument('--file-size', type=int, default=16, help='size of each file in MiB')
+    parser.add_argument('--range-ratio', type=float, default=0.5,
+                        help='fraction of requests that ask for a random byte range')
+    parser.add_argument('--latency', type=float, default=50, help='per-request latency in ms')
+    parser.add_argument('--jitter', type=float, default=20, help='random extra latency in ms')
+    parser.add_argument('--bandwidth', type=float, default=20,
+                        help='bandwidth of each fake connection in MiB/s')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of file requests that fail')
+    parser.add_argument('--flood-rate', type=float, default=0,
+                        help='fraction of file requests answered with a flood wait')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='length of flood waits')
+    parser.add_argument('--api-latency', type=float, default=100,
+                        help='latency of other API calls such as get_messages in ms')
+    parser.add_argument('--chat-id', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--revision', help='label for the results, defaults to the git revision')
+    # Set by the benchmark itself for the process that runs a single level
+    parser.add_argument('--level', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -25,9 +25,11 @@ setuptools.setup(
         "aiohttp>=3",
         "telethon>=1.10",
         "yarl>=1",
+        "prometheus_client>=0.7",
     ],
     extras_require={
-        "fast": ["cryptg>=0.2"],
+        "fast": ["cryptg>=0.2", "uvloop>=0.14"],
+        "images": ["Pillow>=7"],
     },
     python_requires="~=3.7",
 
@@ -17,43 +17,58 @@ import asyncio
 import sys
 
 from aiohttp import web
-from telethon import functions
-from tgfilestream.telegram import client, transfer
-from tgfilestream.web_routes import routes
-from tgfilestream.config import host, port, link_prefix, allowed_user, bot_token, debug, show_index, keep_awake, keep_awake_url
+from tgfilestream.startup import timer
+from tgfilestream.telegram import client, transfer, client_ready, fix_session_dc
+from tgfilestream.metrics import metrics_middleware
+from tgfilestream.web_routes import routes, ready_middleware, transcoder
+from tgfilestream.workers import WorkerPool
+from tgfilestream.config import host, port, link_prefix, allowed_user, bot_token, debug, show_index, keep_awake, keep_awake_url, workers
 from tgfilestream.log import log
-from apscheduler.schedulers.background import BackgroundScheduler
-import requests
 
-server = web.Application()
+server = web.Application(middlewares=[metrics_middleware, ready_middleware])
 server.add_routes(routes)
 runner = web.AppRunner(server)
 
 loop = asyncio.get_event_loop()
+worker_pool = WorkerPool(loop)
 
 
 async def start() -> None:
-    await client.start(bot_token=bot_token)
+    timer.mark('imports')
+    # Bind the port first, requests are held by ready_middleware until the client is ready
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=workers > 1).start()
+    timer.mark('http')
 
-    config = await client(functions.help.GetConfigRequest())
-    for option in config.dc_options:
-        if option.ip_address == client.session.server_address:
-            if client.session.dc_id != option.id:
-                log.warning(f"Fixed DC ID in session from {client.session.dc_id} to {option.id}")
-            client.session.set_dc(option.id, option.ip_address, option.port)
-            client.session.save()
-            break
+    await client.start(bot_token=bot_token)
+    timer.mark('login')
     transfer.post_init()
-    await runner.setup()
-    await web.TCPSite(runner, host, port).start()
+    client_ready.set()
+    timer.mark('transfer')
+    timer.report()
+    loop.create_task(finish_startup())
+
+
+async def finish_startup() -> None:
+    # Serving files doesn't depend on this, so it runs after the server is already up
+    try:
+        await fix_session_dc()
+    except Exception:
+        log.warning('Failed to check the DC of the session', exc_info=True)
+    worker_pool.start()
 
 
 async def stop() -> None:
+    await worker_pool.stop()
     await runner.cleanup()
+    await transfer.stop()
+    if transcoder:
+        transcoder.stop()
     await client.disconnect()
 
 
 def keep_wake():
+    import requests
     resp = requests.get(keep_awake_url)
     log.debug('keep_wake', 'get', str(keep_awake_url), 'result', resp.status_code, resp.content)
 
@@ -70,19 +85,22 @@ log.debug(f'Public URL prefix is {link_prefix}')
 log.debug(f'allowed user ids {allowed_user}')
 log.debug(f'Debug={debug},show_index={show_index}')
 
-scheduler = BackgroundScheduler()
+scheduler = None
 
 try:
     if keep_awake:
+        # Only needed to keep free dynos awake, so it isn't imported otherwise
+        from apscheduler.schedulers.background import BackgroundScheduler
+        scheduler = BackgroundScheduler()
         scheduler.add_job(keep_wake, 'interval', seconds=120)
         scheduler.start()
     loop.run_forever()
 except KeyboardInterrupt:
-    if keep_awake:
+    if scheduler:
         scheduler.shutdown()
     loop.run_until_complete(stop())
 except Exception:
     log.fatal('Fatal error in event loop', exc_info=True)
-    if keep_awake:
+    if scheduler:
         scheduler.shutdown()
     sys.exit(3)
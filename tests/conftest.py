@@ -0,0 +1,6 @@
+import os
+
+# The configuration is read when the package is imported and exits without these
+os.environ.setdefault('TG_API_ID', '1')
+os.environ.setdefault('TG_API_HASH', 'test')
+os.environ.setdefault('TG_BOT_TOKEN', '1:test')
@@ -0,0 +1,109 @@
+import base64
+
+import pytest
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+from tgfilestream import linkid
+
+users = [12345678, 123456789, 5123456789]
+chats = [-123456789, -987654321]
+channels = [-1001234567890, -1009999999999]
+msg_ids = [1, 42, 1234, 123456, 9999999]
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    linkid.decode.cache_clear()
+    yield
+    linkid.decode.cache_clear()
+
+
+def legacy_length(peer_id: int, msg_id: int) -> int:
+    is_channel = str(peer_id).startswith('-100')
+    is_group = peer_id < 0 and not is_channel
+    text = f'{peer_id}|{msg_id}|{int(is_group)}|{int(is_channel)}'
+    # ARC4 keeps the length of the text, the old links were padded base64 of it
+    return len(base64.urlsafe_b64encode(bytes(len(text))))
+
+
+def tamper(link_id: str, index: int) -> str:
+    char = 'A' if link_id[index] != 'A' else 'B'
+    return link_id[:index] + char + link_id[index + 1:]
+
+
+@pytest.mark.parametrize('peer_id', users + chats + channels)
+@pytest.mark.parametrize('msg_id', msg_ids)
+def test_not_longer_than_legacy(peer_id, msg_id):
+    assert len(linkid.encode(peer_id, msg_id)) <= legacy_length(peer_id, msg_id)
+
+
+@pytest.mark.parametrize('peer_id, peer', [
+    (123456789, InputPeerUser(user_id=123456789, access_hash=0)),
+    (-123456789, InputPeerChat(chat_id=123456789)),
+    (-1001234567890, InputPeerChannel(channel_id=1234567890, access_hash=0)),
+])
+@pytest.mark.parametrize('msg_id', msg_ids)
+def test_round_trip(peer_id, peer, msg_id):
+    link = linkid.decode(linkid.encode(peer_id, msg_id))
+    assert link == linkid.LinkID(peer, msg_id)
+
+
+def test_tampered_mac(monkeypatch):
+    monkeypatch.setattr(linkid, 'legacy_links', False)
+    link_id = linkid.encode(123456789, 1234)
+    assert linkid.decode(tamper(link_id, len(link_id) - 1)) is None
+
+
+def test_legacy_link_shaped_like_signed(monkeypatch):
+    # Legacy IDs that parse as signed ones with a wrong signature still work as legacy links
+    monkeypatch.setattr(linkid.StringCoder, 'decode', lambda text: '1|2|0|0')
+    link_id = linkid.encode(123456789, 1234)
+    link_id = tamper(link_id, len(link_id) - 1)
+    assert linkid.decode(link_id) == linkid.LinkID(InputPeerUser(user_id=1, access_hash=0), 2)
+
+
+def test_tampered_body():
+    link_id = linkid.encode(123456789, 1234)
+    assert linkid.decode(tamper(link_id, 2)) is None
+
+
+def test_other_secret(monkeypatch):
+    link_id = linkid.encode(123456789, 1234)
+    monkeypatch.setattr(linkid, 'secret', b'another secret')
+    assert linkid.decode(link_id) is None
+
+
+def test_unknown_flags():
+    body = bytes([linkid.version << linkid.version_shift | 0b100]) + bytes([1, 1])
+    link_id = base64.urlsafe_b64encode(body + linkid._sign(body)).rstrip(b'=').decode()
+    assert linkid.decode(link_id) is None
+    body = bytes([linkid.version << linkid.version_shift | 0b11]) + bytes([1, 1])
+    link_id = base64.urlsafe_b64encode(body + linkid._sign(body)).rstrip(b'=').decode()
+    assert linkid.decode(link_id) is None
+
+
+def test_unknown_version():
+    body = bytes([2 << linkid.version_shift]) + bytes([1, 1])
+    link_id = base64.urlsafe_b64encode(body + linkid._sign(body)).rstrip(b'=').decode()
+    assert linkid.decode(link_id) is None
+
+
+@pytest.mark.parametrize('cut', [1, 2, 5, 11])
+def test_truncated(cut):
+    link_id = linkid.encode(-1001234567890, 123456)
+    assert linkid.decode(link_id[:-cut]) is None
+
+
+def test_overlong_varint():
+    body = bytes([linkid.version << linkid.version_shift, 0x81, 0x00, 1])
+    link_id = base64.urlsafe_b64encode(body + linkid._sign(body)).rstrip(b'=').decode()
+    assert linkid.decode(link_id) is None
+
+
+def test_legacy_links(monkeypatch):
+    monkeypatch.setattr(linkid.StringCoder, 'decode', lambda text: '123456789|42|0|0')
+    assert linkid.decode('bGVnYWN5IGxpbmsgaWQ=') == linkid.LinkID(
+        InputPeerUser(user_id=123456789, access_hash=0), 42)
+    linkid.decode.cache_clear()
+    monkeypatch.setattr(linkid, 'legacy_links', False)
+    assert linkid.decode('bGVnYWN5IGxpbmsgaWQ=') is None
@@ -0,0 +1,163 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import os
+import sqlite3
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from telethon.sessions import Session, SQLiteSession
+
+# How long worker processes wait for the main process to release the database, in seconds
+worker_lock_timeout = 0.5
+
+
+# A table of our own in the Telethon session database. The main process goes through the
+# connection of the session, worker processes use an in-memory copy of the session and open the
+# database file themselves.
+#
+# Telethon keeps a write transaction open in the main process between saves of the session, so
+# workers write from a thread with a connection of its own, where waiting for the lock doesn't
+# block the event loop. Writes that still find the database locked are skipped.
+class SessionTable:
+    log: logging.Logger = logging.getLogger(__name__)
+    table: str
+    columns: str
+
+    session: Session
+    filename: str
+
+    _conn: Optional[sqlite3.Connection]
+    _writer: Optional[ThreadPoolExecutor]
+    _writer_conn: Optional[sqlite3.Connection]
+
+    def __init__(self, session: Session, filename: str,
+                 conn: Optional[sqlite3.Connection] = None) -> None:
+        self.session = session
+        self.filename = filename
+        self._conn = conn
+        self._writer = ThreadPoolExecutor(1) if conn else None
+        self._writer_conn = None
+
+    @classmethod
+    def for_session(cls, session: Session, filename: Optional[str] = None
+                    ) -> Optional['SessionTable']:
+        try:
+            if isinstance(session, SQLiteSession) and session.filename != ':memory:':
+                store = cls(session, session.filename)
+            elif filename:
+                store = cls(session, filename, sqlite3.connect(
+                    filename, timeout=worker_lock_timeout, isolation_level=None))
+            else:
+                return None
+            store._execute(f'create table if not exists {cls.table} ({cls.columns})')
+            store._commit()
+        except sqlite3.Error:
+            cls.log.warning(f'Failed to open {cls.table}', exc_info=True)
+            return None
+        return store
+
+    def _execute(self, stmt: str, *values: Any) -> List[tuple]:
+        if not self._conn:
+            cursor = self.session._cursor()
+            try:
+                return cursor.execute(stmt, values).fetchall()
+            finally:
+                cursor.close()
+        return self._conn.execute(stmt, values).fetchall()
+
+    def _write(self, error: str, stmt: str, *values: Any) -> None:
+        if self._writer:
+            self._writer.submit(self._write_now, error, stmt, *values)
+        else:
+            self._write_now(error, stmt, *values)
+
+    def _write_now(self, error: str, stmt: str, *values: Any) -> None:
+        try:
+            if self._writer:
+                if not self._writer_conn:
+                    self._writer_conn = sqlite3.connect(self.filename, timeout=worker_lock_timeout,
+                                                        isolation_level=None)
+                self._writer_conn.execute(stmt, values)
+            else:
+                self._execute(stmt, *values)
+            self._commit()
+        except sqlite3.Error:
+            self.log.warning(error, exc_info=True)
+
+    def _commit(self) -> None:
+        if not self._conn:
+            self.session.save()
+        try:
+            # The file holds authorization keys, so nobody else should be able to read it
+            if os.stat(self.filename).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+                os.chmod(self.filename, stat.S_IRUSR | stat.S_IWUSR)
+        except OSError:
+            self.log.warning('Failed to restrict the permissions of the session file',
+                             exc_info=True)
+
+
+# Stores the auth keys exported to other DCs in the Telethon session database, so connections to
+# those DCs can be opened without exporting the authorization again after a restart. Keys are
+# tied to the key of the home DC, and are ignored once the session itself has been replaced.
+class AuthKeyStore(SessionTable):
+    table = 'tgfilestream_exported_auth'
+    columns = 'dc_id integer primary key, home_key_id text, auth_key blob, date integer'
+
+    @property
+    def _home_key_id(self) -> Optional[str]:
+        auth_key = self.session.auth_key
+        # Key IDs are unsigned 64-bit integers, which don't fit in an SQLite integer
+        return f'{auth_key.key_id:016x}' if auth_key and auth_key.key else None
+
+    def load(self) -> Dict[int, bytes]:
+        home_key_id = self._home_key_id
+        keys = {}
+        try:
+            rows = self._execute(f'select dc_id, home_key_id, auth_key from {self.table}')
+        except sqlite3.Error:
+            self.log.warning('Failed to load the stored auth keys', exc_info=True)
+            return keys
+        for dc_id, key_id, auth_key in rows:
+            if key_id == home_key_id and auth_key:
+                keys[dc_id] = auth_key
+            else:
+                self.log.info(f'Discarding stored auth for DC {dc_id} from an old session')
+                self.delete(dc_id)
+        return keys
+
+    def get(self, dc_id: int) -> Optional[bytes]:
+        try:
+            rows = self._execute(f'select auth_key from {self.table} where dc_id = ? and'
+                                 ' home_key_id = ?', dc_id, self._home_key_id)
+        except sqlite3.Error:
+            self.log.warning(f'Failed to look up the stored auth for DC {dc_id}', exc_info=True)
+            return None
+        return rows[0][0] if rows and rows[0][0] else None
+
+    def save(self, dc_id: int, auth_key: bytes) -> None:
+        home_key_id = self._home_key_id
+        if home_key_id is None:
+            return
+        self._write(f'Failed to store the auth for DC {dc_id}',
+                    f'insert or replace into {self.table} values (?, ?, ?, ?)',
+                    dc_id, home_key_id, auth_key, int(time.time()))
+
+    def delete(self, dc_id: int) -> None:
+        self._write(f'Failed to delete the stored auth for DC {dc_id}',
+                    f'delete from {self.table} where dc_id = ?', dc_id)
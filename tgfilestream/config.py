@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import os
+import socket
 import sys
+import tempfile
 
 from yarl import URL
 
@@ -42,10 +44,20 @@ link_prefix = URL(os.environ.get('LINK_PREFIX', public_url))
 keep_awake = os.environ.get('KEEP_AWAKE', '0') != '0'
 keep_awake_url = os.environ.get('KEEP_AWAKE_URL', link_prefix)
 session = "dyimg"
+session_file = f'{session}.session'
 log_config = os.environ.get('LOG_CONFIG')
 debug = os.environ.get('DEBUG', '0') != '0'
 web_api_key = os.environ.get('WEB_API_KEY', None)
 show_index = os.environ.get('SHOW_INDEX', '0') != '0'
+enable_metrics = os.environ.get('ENABLE_METRICS', '0') != '0'
+cache_control = os.environ.get('CACHE_CONTROL', 'public, max-age=86400')
+# The key used to sign links, derived from the bot token if unset
+link_secret = os.environ.get('LINK_SECRET', '')
+# Whether the unsigned links made before link signing are still accepted
+legacy_links = os.environ.get('LEGACY_LINKS', '1') != '0'
+persist_dc_auth = os.environ.get('PERSIST_DC_AUTH', '1') != '0'
+file_index = os.environ.get('FILE_INDEX', '1') != '0'
+use_uvloop = os.environ.get('USE_UVLOOP', '0') != '0'
 
 if web_api_key == '':
     web_api_key = None
@@ -57,6 +69,22 @@ except ValueError:
     print('Please make sure the REQUEST_LIMIT environment variable is an integer')
     sys.exit(1)
 
+try:
+    # The per-user and global bandwidth limits in bytes per second, 0 to disable
+    client_bandwidth = int(os.environ.get('CLIENT_BANDWIDTH', '0'))
+    global_bandwidth = int(os.environ.get('GLOBAL_BANDWIDTH', '0'))
+    # How long a user without ongoing requests is remembered, in seconds
+    client_idle_timeout = int(os.environ.get('CLIENT_IDLE_TIMEOUT', '300'))
+    # The number of reverse proxies in front of the server that append to X-Forwarded-For
+    trusted_proxy_count = int(os.environ.get('TRUSTED_PROXY_COUNT', '1'))
+except ValueError:
+    trusted_proxy_count = 0
+if trusted_proxy_count < 1:
+    print('Please make sure the CLIENT_BANDWIDTH, GLOBAL_BANDWIDTH, CLIENT_IDLE_TIMEOUT and'
+          ' TRUSTED_PROXY_COUNT environment variables are integers, and TRUSTED_PROXY_COUNT is'
+          ' positive')
+    sys.exit(1)
+
 try:
     # The per-DC connection limit
     connection_limit = int(os.environ.get('CONNECTION_LIMIT', '20'))
@@ -64,6 +92,197 @@ except ValueError:
     print('Please make sure the CONNECTION_LIMIT environment variable is an integer')
     sys.exit(1)
 
+try:
+    # The number of processes serving files on the same port
+    workers = int(os.environ.get('WORKERS', '1'))
+    # Set by the main process for the workers it starts, the main process itself is worker 0
+    worker_index = int(os.environ.get('WORKER_INDEX', '0'))
+except ValueError:
+    workers = 0
+if workers < 1:
+    print('Please make sure the WORKERS environment variable is a positive integer')
+    sys.exit(1)
+if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+    print('Running multiple WORKERS requires SO_REUSEPORT, which this platform does not support')
+    sys.exit(1)
+if workers > max(connection_limit, 1):
+    # Every worker needs at least one connection of its own to each DC
+    workers = max(connection_limit, 1)
+    print(f'WORKERS is above CONNECTION_LIMIT, only starting {workers} workers')
+# The workers share the per-DC connection limit
+worker_connection_limit = max(connection_limit // workers, 1)
+
+# With several processes, each of them writes its metrics to files in this directory, and the
+# process that gets scraped adds them all up. prometheus_client reads it when it's imported, so
+# the main process sets it up here, and the workers inherit it.
+metrics_dir = ''
+# Whether the directory was made for this run, and is removed when it ends
+temporary_metrics_dir = False
+if enable_metrics and workers > 1:
+    metrics_dir = (os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+                   or os.environ.get('prometheus_multiproc_dir', ''))
+    if not worker_index:
+        if metrics_dir:
+            # Metrics of the previous run
+            os.makedirs(metrics_dir, exist_ok=True)
+            for entry in os.scandir(metrics_dir):
+                if entry.is_file() and entry.name.endswith('.db'):
+                    os.unlink(entry.path)
+        else:
+            metrics_dir = tempfile.mkdtemp(prefix='tgfilestream-metrics-')
+            temporary_metrics_dir = True
+        # Older prometheus_client versions only read the lowercase name
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = os.environ['prometheus_multiproc_dir'] = metrics_dir
+
+try:
+    # The number of file requests in flight on each pooled connection, requests beyond that
+    # wait for their turn in the DC's fair queue
+    requests_per_connection = int(os.environ.get('REQUESTS_PER_CONNECTION', '2'))
+except ValueError:
+    requests_per_connection = 0
+if requests_per_connection < 1:
+    print('Please make sure the REQUESTS_PER_CONNECTION environment variable is a positive'
+          ' integer')
+    sys.exit(1)
+
+hedge_requests = os.environ.get('HEDGE_REQUESTS', '0') != '0'
+try:
+    # The largest fraction of file requests that may be sent again on another connection when
+    # they're slower than usual
+    hedge_budget = float(os.environ.get('HEDGE_BUDGET', '0.05'))
+except ValueError:
+    hedge_budget = -1
+if not 0 <= hedge_budget <= 1:
+    print('Please make sure the HEDGE_BUDGET environment variable is a number between 0 and 1')
+    sys.exit(1)
+
+try:
+    # The number of connections kept open to each DC even when idle
+    min_connections = int(os.environ.get('MIN_CONNECTIONS', '1'))
+    # How long a connection above the minimum may stay unused before it's closed, in seconds
+    connection_idle_timeout = int(os.environ.get('CONNECTION_IDLE_TIMEOUT', '300'))
+    # How often idle connections are pinged to check that they're alive, in seconds
+    ping_interval = int(os.environ.get('PING_INTERVAL', '60'))
+except ValueError:
+    print('Please make sure the MIN_CONNECTIONS, CONNECTION_IDLE_TIMEOUT and PING_INTERVAL'
+          ' environment variables are integers')
+    sys.exit(1)
+if ping_interval < 1:
+    print('Please make sure the PING_INTERVAL environment variable is a positive integer')
+    sys.exit(1)
+
+try:
+    # The number of file requests per second and the burst allowed to each DC, 0 to disable
+    dc_request_rate = float(os.environ.get('DC_REQUEST_RATE', '50'))
+    dc_request_burst = float(os.environ.get('DC_REQUEST_BURST', '50'))
+    # Flood waits longer than this many seconds fail the request instead of being waited out
+    max_flood_wait = int(os.environ.get('MAX_FLOOD_WAIT', '60'))
+except ValueError:
+    print('Please make sure the DC_REQUEST_RATE, DC_REQUEST_BURST and MAX_FLOOD_WAIT environment'
+          ' variables are numbers')
+    sys.exit(1)
+
+try:
+    # The number of requests a single download keeps in flight over the DC's pooled connections
+    download_prefetch = int(os.environ.get('DOWNLOAD_PREFETCH', '8'))
+except ValueError:
+    download_prefetch = 0
+if download_prefetch < 1:
+    print('Please make sure the DOWNLOAD_PREFETCH environment variable is a positive integer')
+    sys.exit(1)
+
+try:
+    # How far a single download may read ahead of what has been sent to the client, in bytes
+    stream_read_ahead = int(os.environ.get('STREAM_READ_AHEAD', str(4 * 1024 * 1024)))
+    # How long a client may stop reading before its download is aborted, in seconds
+    stream_write_timeout = int(os.environ.get('STREAM_WRITE_TIMEOUT', '60'))
+except ValueError:
+    print('Please make sure the STREAM_READ_AHEAD and STREAM_WRITE_TIMEOUT environment variables'
+          ' are integers')
+    sys.exit(1)
+
+try:
+    # How far ahead of a client's sequential range requests file parts are prefetched, and the
+    # limit of prefetched bytes in flight for all clients, in bytes
+    sequential_prefetch = int(os.environ.get('SEQUENTIAL_PREFETCH', str(4 * 1024 * 1024)))
+    sequential_prefetch_total = int(os.environ.get('SEQUENTIAL_PREFETCH_TOTAL',
+                                                   str(32 * 1024 * 1024)))
+except ValueError:
+    sequential_prefetch = -1
+if sequential_prefetch < 0:
+    print('Please make sure the SEQUENTIAL_PREFETCH and SEQUENTIAL_PREFETCH_TOTAL environment'
+          ' variables are non-negative integers')
+    sys.exit(1)
+
+try:
+    # How long and how many message metadata lookups are cached
+    meta_cache_ttl = int(os.environ.get('META_CACHE_TTL', '300'))
+    meta_cache_size = int(os.environ.get('META_CACHE_SIZE', '1024'))
+except ValueError:
+    print('Please make sure the META_CACHE_TTL and META_CACHE_SIZE environment variables'
+          ' are integers')
+    sys.exit(1)
+
+try:
+    # The chat files uploaded through the web API are sent to, uploads are disabled if unset
+    upload_chat_id = int(os.environ.get('UPLOAD_CHAT_ID', '0'))
+    # The number of parts a single upload keeps in flight
+    upload_parallel = int(os.environ.get('UPLOAD_PARALLEL', '8'))
+except ValueError:
+    upload_parallel = 0
+if upload_parallel < 1:
+    print('Please make sure the UPLOAD_CHAT_ID environment variable is an integer and'
+          ' UPLOAD_PARALLEL is a positive integer')
+    sys.exit(1)
+
+transcode_images = os.environ.get('TRANSCODE_IMAGES', '0') != '0'
+try:
+    # The number of processes converting images, and the memory for the converted images
+    # Every serving process has its own pool, so by default they share the CPUs with each other
+    # and with serving
+    transcode_workers = int(os.environ.get('TRANSCODE_WORKERS',
+                                           str(max((os.cpu_count() or 1) // (workers + 1), 1))))
+    transcode_cache_size = int(os.environ.get('TRANSCODE_CACHE_SIZE', str(64 * 1024 * 1024)))
+    # Larger images are served as they are
+    transcode_max_size = int(os.environ.get('TRANSCODE_MAX_SIZE', str(20 * 1024 * 1024)))
+    transcode_quality = int(os.environ.get('TRANSCODE_QUALITY', '80'))
+    # Images that may be downloaded and converted at once, the others are served as they are
+    transcode_queue = int(os.environ.get('TRANSCODE_QUEUE', str(transcode_workers * 4)))
+except ValueError:
+    transcode_workers = 0
+if transcode_workers < 1 or transcode_queue < 1:
+    print('Please make sure the TRANSCODE_WORKERS, TRANSCODE_CACHE_SIZE, TRANSCODE_MAX_SIZE,'
+          ' TRANSCODE_QUALITY and TRANSCODE_QUEUE environment variables are integers, and'
+          ' TRANSCODE_WORKERS and TRANSCODE_QUEUE are positive')
+    sys.exit(1)
+
+try:
+    # Requests that take longer than this many seconds keep their trace, tracing is off if 0
+    slow_request_threshold = float(os.environ.get('SLOW_REQUEST_THRESHOLD', '0'))
+    # How many of the most recent slow traces are kept for the debug route
+    slow_request_log_size = int(os.environ.get('SLOW_REQUEST_LOG_SIZE', '100'))
+except ValueError:
+    slow_request_threshold = -1
+    slow_request_log_size = 0
+if slow_request_threshold < 0 or slow_request_log_size < 1:
+    print('Please make sure the SLOW_REQUEST_THRESHOLD environment variable is a non-negative'
+          ' number and SLOW_REQUEST_LOG_SIZE is a positive integer')
+    sys.exit(1)
+# A Zipkin compatible collector the slow traces are also sent to, not sent if unset
+trace_export_url = os.environ.get('TRACE_EXPORT_URL', '')
+
+# The directory to cache downloaded file parts in, disabled if unset
+disk_cache_dir = os.environ.get('DISK_CACHE_DIR', '')
+try:
+    # The maximum total size of the disk cache in bytes
+    disk_cache_size = int(os.environ.get('DISK_CACHE_SIZE', str(1024 * 1024 * 1024)))
+    # The maximum total size of the in-memory hot part cache in bytes
+    memory_cache_size = int(os.environ.get('MEMORY_CACHE_SIZE', str(64 * 1024 * 1024)))
+except ValueError:
+    print('Please make sure the DISK_CACHE_SIZE and MEMORY_CACHE_SIZE environment variables'
+          ' are integers')
+    sys.exit(1)
+
 allowed_user = os.environ.get('ALLOW_USER_IDS', '').split(',')
 max_file_size = int(os.environ.get('MAX_FILE_SIZE', str(1024 * 1024 * 20)))
 try:
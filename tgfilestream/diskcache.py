@@ -0,0 +1,143 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+part_suffix = '.part'
+temp_suffix = '.tmp'
+
+
+# An LRU cache of downloaded file parts, stored as one file per (file key, part index)
+class DiskPartCache:
+    log: logging.Logger = logging.getLogger(__name__)
+    loop: asyncio.AbstractEventLoop
+
+    path: str
+    max_size: int
+    size: int
+
+    _index: 'OrderedDict[str, int]'
+    _lock: threading.Lock
+
+    def __init__(self, path: str, max_size: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.loop = loop
+        self.size = 0
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _name(key: str, part: int) -> str:
+        return f'{key}_{part}{part_suffix}'
+
+    def load(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(temp_suffix):
+                # Leftovers of writes that were interrupted by a crash
+                os.unlink(entry.path)
+                continue
+            if not entry.name.endswith(part_suffix):
+                # The directory may be shared with other files, like the session
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        with self._lock:
+            self._index.clear()
+            self.size = 0
+            for _, name, size in entries:
+                self._index[name] = size
+                self.size += size
+        self.log.info(f'Loaded {len(self._index)} cached parts ({self.size} bytes)')
+        self._evict()
+
+    def contains(self, key: str, part: int) -> bool:
+        with self._lock:
+            return self._name(key, part) in self._index
+
+    def _evict(self) -> None:
+        while True:
+            with self._lock:
+                if self.size <= self.max_size or not self._index:
+                    return
+                name, size = self._index.popitem(last=False)
+                self.size -= size
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                self.log.warning(f'Failed to remove evicted part {name}', exc_info=True)
+
+    def _read(self, name: str, start: int, end: Optional[int]) -> Optional[memoryview]:
+        path = os.path.join(self.path, name)
+        try:
+            # The mapping is closed once the last view of it is gone, so hits are written to the
+            # socket straight from the page cache. Parts are only ever replaced or unlinked, never
+            # truncated, so the mapped pages stay valid after eviction.
+            with open(path, 'rb') as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                size = self._index.pop(name, None)
+                if size is not None:
+                    self.size -= size
+            return None
+        with self._lock:
+            if name in self._index:
+                self._index.move_to_end(name)
+        return memoryview(data)[start:end]
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = os.path.join(self.path, name)
+        temp_path = f'{path}.{threading.get_ident()}{temp_suffix}'
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        except OSError:
+            self.log.warning(f'Failed to cache part {name}', exc_info=True)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            old_size = self._index.pop(name, 0)
+            self._index[name] = len(data)
+            self.size += len(data) - old_size
+        self._evict()
+
+    async def read(self, key: str, part: int, start: int = 0, end: Optional[int] = None
+                   ) -> Optional[memoryview]:
+        return await self.loop.run_in_executor(None, self._read, self._name(key, part),
+                                               start, end)
+
+    def write(self, key: str, part: int, data: bytes) -> None:
+        if not data or len(data) > self.max_size:
+            return
+        self.loop.run_in_executor(None, self._write, self._name(key, part), data)
@@ -0,0 +1,101 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import time
+from typing import Any, Dict
+
+from .config import dc_request_rate, dc_request_burst, workers
+
+# The request rate never drops below this fraction of the configured rate after flood waits
+min_rate_factor = 0.1
+# How long it takes the request rate to recover from a halving, in seconds
+rate_recovery_time = 60
+
+
+# A token bucket for the requests sent to one DC. Flood waits reported by Telegram block every
+# request to the DC until the wait is over and halve the rate, which then slowly recovers.
+class RateGovernor:
+    log: logging.Logger
+
+    max_rate: float
+    rate: float
+    burst: float
+    tokens: float
+    blocked_until: float
+    flood_waits: int
+
+    _updated: float
+
+    # Worker processes split the configured rate between them
+    def __init__(self, log: logging.Logger, rate: float = dc_request_rate / workers,
+                 burst: float = dc_request_burst / workers) -> None:
+        self.log = log
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.blocked_until = 0
+        self.flood_waits = 0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        self.rate = min(self.max_rate, self.rate + self.max_rate * elapsed / rate_recovery_time)
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+
+    async def acquire(self) -> None:
+        if self.max_rate <= 0:
+            # Rate limiting is disabled, only honor flood waits
+            while self.blocked_until > time.monotonic():
+                await asyncio.sleep(self.blocked_until - time.monotonic())
+            return
+        while True:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.flood_waits += 1
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        if self.max_rate > 0:
+            self._refill(now)
+            self.rate = max(self.rate / 2, self.max_rate * min_rate_factor)
+            self.tokens = 0
+        self.log.warning(f'Flood wait of {seconds} seconds, throttling requests'
+                         f' to {self.rate:.1f}/s')
+
+    @property
+    def throttled(self) -> bool:
+        return self.blocked_until > time.monotonic() or self.rate < self.max_rate
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            'rate': self.rate,
+            'max_rate': self.max_rate,
+            'tokens': self.tokens,
+            'blocked_for': max(self.blocked_until - time.monotonic(), 0),
+            'flood_waits': self.flood_waits,
+            'throttled': self.throttled,
+        }
@@ -0,0 +1,63 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import deque
+from typing import Deque
+
+from .config import hedge_budget
+
+# Requests are duplicated once they take longer than this percentile of recent requests
+hedge_percentile = 0.95
+latency_samples = 256
+# The delay is recalculated after this many new samples
+recalculate_interval = 32
+# The delay used until there are enough samples, and the lowest delay ever used, in seconds
+initial_delay = 1.0
+min_delay = 0.05
+# How many unused hedges can be saved up for a burst of slow requests
+max_saved_hedges = 10
+
+
+# Decides when a slow request to a DC is sent again on another connection. Every request earns
+# a fraction of a hedge, so at most hedge_budget of the requests are ever duplicated.
+class HedgePolicy:
+    delay: float
+    tokens: float
+
+    _samples: Deque[float]
+    _new_samples: int
+
+    def __init__(self) -> None:
+        self.delay = initial_delay
+        self.tokens = max_saved_hedges
+        self._samples = deque(maxlen=latency_samples)
+        self._new_samples = 0
+
+    def record(self, duration: float) -> None:
+        self._samples.append(duration)
+        self._new_samples += 1
+        if self._new_samples >= recalculate_interval:
+            self._new_samples = 0
+            ordered = sorted(self._samples)
+            self.delay = max(ordered[int(len(ordered) * hedge_percentile)], min_delay)
+
+    def earn(self) -> None:
+        self.tokens = min(self.tokens + hedge_budget, max_saved_hedges)
+
+    def spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
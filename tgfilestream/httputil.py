@@ -0,0 +1,130 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+
+# More ranges than this in one request are ignored and the whole file is served instead
+max_ranges = 16
+
+ByteRange = Tuple[int, int]
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def http_date(date: datetime) -> str:
+    return format_datetime(date, usegmt=True)
+
+
+def parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _split_etags(value: str) -> List[str]:
+    return [tag.strip() for tag in value.split(',') if tag.strip()]
+
+
+def _weak_match(tag: str, etag: str) -> bool:
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return tag == etag
+
+
+def is_not_modified(req: web.Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = req.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = _split_etags(if_none_match)
+        return '*' in tags or any(_weak_match(tag, etag) for tag in tags)
+    if_modified_since = parse_http_date(req.headers.get('If-Modified-Since'))
+    if if_modified_since is not None:
+        try:
+            return last_modified <= if_modified_since
+        except TypeError:
+            return False
+    return False
+
+
+def range_applies(req: web.Request, etag: str, last_modified: datetime) -> bool:
+    if_range = req.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # If-Range requires the strong comparison function
+        return not etag.startswith('W/') and if_range == etag
+    date = parse_http_date(if_range)
+    try:
+        return date is not None and last_modified == date
+    except TypeError:
+        return False
+
+
+# Parses a Range header into (start, stop) pairs with an exclusive stop. Returns None if the
+# whole file should be served and raises RangeNotSatisfiable if no range overlaps the file.
+def parse_range(value: Optional[str], size: int) -> Optional[List[ByteRange]]:
+    if not value:
+        return None
+    unit, sep, spec = value.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+    ranges: List[ByteRange] = []
+    items = [item.strip() for item in spec.split(',') if item.strip()]
+    if not items:
+        return None
+    for item in items:
+        first, sep, last = item.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last):
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                start, stop = max(0, size - suffix), size
+            else:
+                start = int(first)
+                stop = int(last) + 1 if last else size
+                if start < 0 or (last and stop <= start):
+                    return None
+                stop = min(stop, size)
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, stop))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    if len(ranges) > max_ranges:
+        return None
+    return ranges
+
+
+def content_range(start: int, stop: int, size: int) -> str:
+    return f'bytes {start}-{stop - 1}/{size}'
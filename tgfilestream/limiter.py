@@ -0,0 +1,139 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+import weakref
+from typing import AsyncGenerator, Dict, Optional
+
+from async_generator import aclosing
+
+from .config import request_limit, client_bandwidth, global_bandwidth, client_idle_timeout
+
+
+# A token bucket on bytes. Consuming more than is available puts the bucket in debt, and the
+# consumer waits until the debt would have been paid off.
+class ByteBucket:
+    rate: float
+    burst: float
+    tokens: float
+
+    _updated: float
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def consume(self, size: int) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= size
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class ClientState:
+    streams: int
+    last_seen: float
+    bucket: Optional[ByteBucket]
+
+    def __init__(self) -> None:
+        self.streams = 0
+        self.last_seen = time.monotonic()
+        self.bucket = ByteBucket(client_bandwidth) if client_bandwidth > 0 else None
+
+
+class StreamSlot:
+    limiter: 'ClientLimiter'
+    ip: str
+    client: ClientState
+    released: bool
+
+    def __init__(self, limiter: 'ClientLimiter', ip: str, client: ClientState) -> None:
+        self.limiter = limiter
+        self.ip = ip
+        self.client = client
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.limiter.release(self)
+
+    async def throttle(self, size: int) -> None:
+        if self.client.bucket:
+            await self.client.bucket.consume(size)
+        if self.limiter.bucket:
+            await self.limiter.bucket.consume(size)
+
+    def wrap(self, body: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+        wrapped = self._wrap(body)
+        # Bodies that are never iterated still give their slot back once they're collected
+        weakref.finalize(wrapped, self.release)
+        return wrapped
+
+    async def _wrap(self, body: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+        try:
+            async with aclosing(body):
+                async for chunk in body:
+                    await self.throttle(len(chunk))
+                    yield chunk
+        finally:
+            self.release()
+
+
+class ClientLimiter:
+    clients: Dict[str, ClientState]
+    bucket: Optional[ByteBucket]
+
+    _last_sweep: float
+
+    def __init__(self) -> None:
+        self.clients = {}
+        self.bucket = ByteBucket(global_bandwidth) if global_bandwidth > 0 else None
+        self._last_sweep = time.monotonic()
+
+    def _sweep(self, now: float) -> None:
+        if now - self._last_sweep < client_idle_timeout:
+            return
+        self._last_sweep = now
+        expired = [ip for ip, client in self.clients.items()
+                   if client.streams == 0 and now - client.last_seen > client_idle_timeout]
+        for ip in expired:
+            del self.clients[ip]
+
+    def acquire(self, ip: str) -> Optional[StreamSlot]:
+        now = time.monotonic()
+        self._sweep(now)
+        try:
+            client = self.clients[ip]
+        except KeyError:
+            client = self.clients[ip] = ClientState()
+        client.last_seen = now
+        if client.streams >= request_limit:
+            return None
+        client.streams += 1
+        return StreamSlot(self, ip, client)
+
+    def release(self, slot: StreamSlot) -> None:
+        slot.client.streams -= 1
+        slot.client.last_seen = time.monotonic()
+
+    @property
+    def active_streams(self) -> int:
+        return sum(client.streams for client in self.clients.values())
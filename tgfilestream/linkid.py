@@ -0,0 +1,170 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+from telethon import utils
+from telethon.tl.types import (TypeInputPeer, InputPeerChannel, InputPeerChat, InputPeerUser,
+                               PeerChannel, PeerChat)
+
+from .config import link_secret, bot_token, legacy_links
+from .string_encoder import StringCoder
+
+log = logging.getLogger(__name__)
+
+# Version 1 link IDs are the URL-safe base64 (without padding) of:
+#   a header byte with the version in the top bits and the peer type in the bottom bits,
+#   the unmarked peer ID and the message ID as unsigned varints,
+#   the first mac_size bytes of an HMAC-SHA256 of everything before it.
+# Access hashes aren't included, the peer cache and refreshing them by ID cover that.
+version = 1
+version_shift = 5
+peer_user = 0
+peer_chat = 1
+peer_channel = 2
+peer_type_mask = 0b11
+mac_size = 8
+decode_cache_size = 4096
+
+secret = (link_secret or f'tgfilestream-link:{bot_token}').encode('utf-8')
+
+
+class LinkID(NamedTuple):
+    peer: TypeInputPeer
+    msg_id: int
+
+
+def _sign(data: bytes) -> bytes:
+    return hmac.new(secret, data, hashlib.sha256).digest()[:mac_size]
+
+
+def _write_varint(value: int) -> bytes:
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = shift = 0
+    while offset < len(data):
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            # Only the shortest encoding of each value is valid
+            if not byte and shift:
+                break
+            return value, offset
+        shift += 7
+        if shift > 63:
+            break
+    raise ValueError('Invalid varint')
+
+
+def _split_peer(peer_id: int) -> Tuple[int, int]:
+    real_id, peer_class = utils.resolve_id(peer_id)
+    if peer_class is PeerChannel:
+        return peer_channel, real_id
+    elif peer_class is PeerChat:
+        return peer_chat, real_id
+    return peer_user, real_id
+
+
+def _input_peer(peer_type: int, real_id: int) -> TypeInputPeer:
+    if peer_type == peer_channel:
+        return InputPeerChannel(channel_id=real_id, access_hash=0)
+    elif peer_type == peer_chat:
+        return InputPeerChat(chat_id=real_id)
+    return InputPeerUser(user_id=real_id, access_hash=0)
+
+
+def encode(peer_id: int, msg_id: int) -> str:
+    peer_type, real_id = _split_peer(peer_id)
+    data = (bytes([version << version_shift | peer_type])
+            + _write_varint(real_id) + _write_varint(msg_id))
+    data += _sign(data)
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+# Returns None for IDs that aren't version 1 links, and raises ValueError for ones that are
+# but don't carry a valid signature
+def _decode_v1(link_id: str) -> Optional[LinkID]:
+    try:
+        data = base64.urlsafe_b64decode(link_id + '=' * (-len(link_id) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(data) < 3 + mac_size or data[0] >> version_shift != version:
+        return None
+    peer_type = data[0] & peer_type_mask
+    if data[0] & ~(version << version_shift | peer_type_mask) or peer_type > peer_channel:
+        return None
+    body, mac = data[:-mac_size], data[-mac_size:]
+    try:
+        real_id, offset = _read_varint(body, 1)
+        msg_id, offset = _read_varint(body, offset)
+    except ValueError:
+        return None
+    if offset != len(body):
+        return None
+    if not hmac.compare_digest(mac, _sign(body)):
+        raise ValueError('Invalid link signature')
+    return LinkID(_input_peer(peer_type, real_id), msg_id)
+
+
+# Links made before version 1 are ARC4 encrypted "chat_id|msg_id|is_group|is_channel" strings.
+# They aren't authenticated, so they can be turned off with LEGACY_LINKS=0 once they're no
+# longer handed out.
+def _decode_legacy(link_id: str) -> Optional[LinkID]:
+    try:
+        chat_id, msg_id, is_group, is_channel = StringCoder.decode(link_id).split('|')
+        if bool(int(is_channel)) and bool(int(is_group)):
+            peer = InputPeerChat(chat_id=int(chat_id))
+        else:
+            if bool(int(is_group)):
+                peer = InputPeerChat(chat_id=int(chat_id))
+            elif bool(int(is_channel)):
+                peer = InputPeerChannel(channel_id=int(chat_id), access_hash=0)
+            else:
+                peer = InputPeerUser(user_id=int(chat_id), access_hash=0)
+        return LinkID(peer, int(msg_id))
+    except Exception as ep:
+        log.debug(ep)
+        return None
+
+
+# Decoding has no side effects, so the links of popular files are only checked once
+@lru_cache(maxsize=decode_cache_size)
+def decode(link_id: str) -> Optional[LinkID]:
+    try:
+        link = _decode_v1(link_id)
+    except ValueError:
+        log.debug(f'Link {link_id} has no valid signature')
+        link = None
+    if link or not legacy_links:
+        return link
+    # A few legacy links are shaped like signed ones, and they carry no signature to check anyway
+    link = _decode_legacy(link_id)
+    if link:
+        log.debug(f'Accepted legacy link {link_id}')
+    return link
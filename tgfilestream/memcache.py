@@ -0,0 +1,94 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+from collections import OrderedDict
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+PartKey = Tuple[str, int]
+
+
+# An LRU cache of hot file parts that also coalesces concurrent fetches of the same part
+class MemoryPartCache:
+    loop: asyncio.AbstractEventLoop
+
+    max_size: int
+    size: int
+
+    _parts: 'OrderedDict[PartKey, bytes]'
+    _inflight: Dict[PartKey, asyncio.Future]
+
+    def __init__(self, max_size: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.max_size = max_size
+        self.loop = loop
+        self.size = 0
+        self._parts = OrderedDict()
+        self._inflight = {}
+
+    def get(self, key: str, part: int) -> Optional[bytes]:
+        try:
+            data = self._parts[(key, part)]
+        except KeyError:
+            return None
+        self._parts.move_to_end((key, part))
+        return data
+
+    def put(self, key: str, part: int, data: bytes) -> None:
+        if not data or len(data) > self.max_size:
+            return
+        old = self._parts.pop((key, part), None)
+        if old is not None:
+            self.size -= len(old)
+        self._parts[(key, part)] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self._parts.popitem(last=False)
+            self.size -= len(evicted)
+
+    def pending(self, key: str, part: int) -> Optional[asyncio.Future]:
+        return self._inflight.get((key, part))
+
+    def has(self, key: str, part: int) -> bool:
+        return (key, part) in self._parts or (key, part) in self._inflight
+
+    def _load_done(self, key: str, parts: List[int], futures: List[asyncio.Future],
+                   task: asyncio.Future) -> None:
+        for part, future in zip(parts, futures):
+            if self._inflight.get((key, part)) is future:
+                del self._inflight[(key, part)]
+        if task.cancelled():
+            for future in futures:
+                future.cancel()
+            return
+        error = task.exception()
+        if error:
+            for future in futures:
+                future.set_exception(error)
+                # Mark the exception as retrieved in case every reader went away
+                future.exception()
+            return
+        for part, future, data in zip(parts, futures, task.result()):
+            self.put(key, part, data)
+            future.set_result(data)
+
+    def load(self, key: str, parts: List[int], loader: Callable[[], Awaitable[List[bytes]]]
+             ) -> List[asyncio.Future]:
+        futures = [self.loop.create_future() for _ in parts]
+        for part, future in zip(parts, futures):
+            self._inflight[(key, part)] = future
+        task = self.loop.create_task(loader())
+        task.add_done_callback(partial(self._load_done, key, parts, futures))
+        return futures
@@ -0,0 +1,289 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple, cast
+
+from telethon import TelegramClient, utils
+from telethon.errors import ChannelInvalidError, PeerIdInvalidError, UserIdInvalidError
+from telethon.extensions import BinaryReader
+from telethon.tl.custom import Message
+from telethon.tl.types import (TypeInputPeer, TypeMessageMedia, TypePhotoSize, MessageMediaPhoto,
+                               MessageMediaDocument, PhotoSize, PhotoCachedSize, PhotoStrippedSize)
+
+from .authstore import SessionTable
+from .config import meta_cache_ttl, meta_cache_size, worker_index
+from .peercache import PeerCache
+from .util import get_file_name
+from . import metrics, trace
+
+MetaKey = Tuple[int, int]
+
+
+@dataclass
+class FileMeta:
+    chat_id: int
+    msg_id: int
+    size: int
+    mime_type: str
+    name: str
+    date: datetime
+    media: TypeMessageMedia
+    # The photo size or document thumbnail being served instead of the file itself, and its
+    # contents if Telegram sent them inline
+    thumb_size: str = ''
+    data: Optional[bytes] = None
+    # The conversion applied to the image, like webp or jpeg640 for a resized jpeg
+    transform: str = ''
+
+    @classmethod
+    def from_message(cls, message: Message) -> 'FileMeta':
+        return cls(chat_id=message.chat_id, msg_id=message.id, size=message.file.size,
+                   mime_type=message.file.mime_type, name=get_file_name(message),
+                   date=message.date, media=message.media)
+
+    @property
+    def file_id(self) -> int:
+        _, location = utils.get_input_location(self.media)
+        return location.id
+
+    @property
+    def etag(self) -> str:
+        tag = f'{self.file_id:x}-{self.size:x}'
+        if self.thumb_size:
+            tag += f'-{self.thumb_size}'
+        if self.transform:
+            tag += f'-{self.transform}'
+        return f'"{tag}"'
+
+    @property
+    def thumbs(self) -> List[TypePhotoSize]:
+        if isinstance(self.media, MessageMediaPhoto) and self.media.photo:
+            return self.media.photo.sizes
+        elif isinstance(self.media, MessageMediaDocument) and self.media.document:
+            return self.media.document.thumbs or []
+        return []
+
+    def variant(self, thumb_size: str) -> Optional['FileMeta']:
+        for thumb in self.thumbs:
+            if thumb.type != thumb_size:
+                continue
+            if isinstance(thumb, PhotoStrippedSize):
+                data = utils.stripped_photo_to_jpg(thumb.bytes)
+            elif isinstance(thumb, PhotoCachedSize):
+                data = thumb.bytes
+            elif isinstance(thumb, PhotoSize):
+                data = None
+            else:
+                continue
+            mime_type = 'image/jpeg'
+            if (isinstance(self.media, MessageMediaDocument)
+                    and self.mime_type in ('image/webp', 'application/x-tgsticker')):
+                # Sticker thumbnails are WebP, every other size Telegram generates is a JPEG
+                mime_type = 'image/webp'
+            return replace(self, size=len(data) if data is not None else thumb.size,
+                           mime_type=mime_type, thumb_size=thumb.type, data=data)
+        return None
+
+
+# The metadata of every file a link was made for, written when the link is made, so requests can
+# be served without looking the message up again. The media is stored in its TL serialization,
+# which keeps the DC, the location and the file reference needed to download it.
+class FileIndex(SessionTable):
+    table = 'tgfilestream_files'
+    columns = ('peer_id integer, msg_id integer, name text, mime_type text, size integer,'
+               ' date integer, media blob, indexed integer, primary key (peer_id, msg_id)')
+
+    def get(self, key: MetaKey) -> Optional[FileMeta]:
+        try:
+            rows = self._execute(f'select name, mime_type, size, date, media from {self.table}'
+                                 ' where peer_id = ? and msg_id = ?', *key)
+        except sqlite3.Error:
+            self.log.warning(f'Failed to look up {key} in the file index', exc_info=True)
+            return None
+        if not rows:
+            return None
+        name, mime_type, size, date, media = rows[0]
+        try:
+            media = BinaryReader(media).tgread_object()
+        except Exception:
+            self.log.warning(f'Discarding unreadable file index entry {key}', exc_info=True)
+            self.delete(key)
+            return None
+        return FileMeta(chat_id=key[0], msg_id=key[1], size=size, mime_type=mime_type, name=name,
+                        date=datetime.fromtimestamp(date, timezone.utc), media=media)
+
+    def save(self, meta: FileMeta) -> None:
+        self._write(f'Failed to index the file in {meta.msg_id} (chat {meta.chat_id})',
+                    f'insert or replace into {self.table} values (?, ?, ?, ?, ?, ?, ?, ?)',
+                    meta.chat_id, meta.msg_id, meta.name, meta.mime_type, meta.size,
+                    int(meta.date.timestamp()), bytes(meta.media), int(time.time()))
+
+    def delete(self, key: MetaKey) -> None:
+        self._write(f'Failed to remove {key} from the file index',
+                    f'delete from {self.table} where peer_id = ? and msg_id = ?', *key)
+
+
+class FileMetaCache:
+    log: logging.Logger = logging.getLogger(__name__)
+    client: TelegramClient
+    peers: PeerCache
+    index: Optional[FileIndex]
+
+    ttl: float
+    max_size: int
+
+    _entries: 'OrderedDict[MetaKey, Tuple[float, FileMeta]]'
+    _inflight: Dict[MetaKey, asyncio.Future]
+    # The lookups started by refresh, which skip the index
+    _refreshing: Dict[MetaKey, asyncio.Future]
+
+    def __init__(self, client: TelegramClient, peers: PeerCache,
+                 index: Optional[FileIndex] = None, ttl: float = meta_cache_ttl,
+                 max_size: int = meta_cache_size) -> None:
+        self.client = client
+        self.peers = peers
+        self.index = index
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._refreshing = {}
+
+    @staticmethod
+    def key(peer: TypeInputPeer, msg_id: int) -> MetaKey:
+        return utils.get_peer_id(peer), int(msg_id)
+
+    def _get_cached(self, key: MetaKey) -> Optional[FileMeta]:
+        try:
+            expiry, meta = self._entries[key]
+        except KeyError:
+            return None
+        if expiry < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return meta
+
+    def _put(self, key: MetaKey, meta: FileMeta) -> None:
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, meta)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _get_message(self, peer: TypeInputPeer, msg_id: int) -> Optional[Message]:
+        with metrics.get_messages_latency.time(), trace.span('get_messages'):
+            return cast(Message, await self.client.get_messages(entity=peer, ids=int(msg_id)))
+
+    async def _fetch_message(self, key: MetaKey, peer: TypeInputPeer, msg_id: int,
+                             refreshing: bool = False) -> Optional[FileMeta]:
+        peer = self.peers.resolve(peer)
+        try:
+            message = await self._get_message(peer, msg_id)
+        except (ChannelInvalidError, PeerIdInvalidError, UserIdInvalidError):
+            self.log.debug(f'Access hash of {key[0]} was rejected, refreshing it')
+            with trace.span('peer_refresh'):
+                fresh = await self.peers.refresh(peer)
+            if not fresh:
+                raise
+            message = await self._get_message(fresh, msg_id)
+        if not message or not message.file:
+            if self.index and refreshing:
+                # The indexed entry would keep getting served until its reference fails again
+                self.log.info(f'The file in {key} is gone, removing it from the index')
+                self.index.delete(key)
+            return None
+        meta = FileMeta.from_message(message)
+        # Workers only write refreshed references, which every worker would need again
+        if self.index and (refreshing or not worker_index):
+            self.index.save(meta)
+        return meta
+
+    async def _fetch(self, key: MetaKey, peer: TypeInputPeer, msg_id: int,
+                     use_index: bool = True) -> Optional[FileMeta]:
+        try:
+            meta = None
+            if self.index and use_index:
+                with trace.span('file_index'):
+                    meta = self.index.get(key)
+                metrics.cache_lookups.labels('index', 'hit' if meta else 'miss').inc()
+            if not meta:
+                meta = await self._fetch_message(key, peer, msg_id, refreshing=not use_index)
+            if not meta:
+                return None
+            # Don't resurrect entries that were invalidated while the lookup was running
+            if self._inflight.get(key) is asyncio.current_task():
+                self._put(key, meta)
+            return meta
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+            if self._refreshing.get(key) is asyncio.current_task():
+                del self._refreshing[key]
+
+    async def get(self, peer: TypeInputPeer, msg_id: int) -> Optional[FileMeta]:
+        key = self.key(peer, msg_id)
+        meta = self._get_cached(key)
+        if meta:
+            metrics.cache_lookups.labels('metadata', 'hit').inc()
+            return meta
+        try:
+            task = self._inflight[key]
+            metrics.cache_lookups.labels('metadata', 'coalesced').inc()
+        except KeyError:
+            metrics.cache_lookups.labels('metadata', 'miss').inc()
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch(key, peer, msg_id))
+        # Shield the shared lookup so one client disconnecting doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    def add(self, message: Message) -> None:
+        meta = FileMeta.from_message(message)
+        self._put((meta.chat_id, meta.msg_id), meta)
+        if self.index and not worker_index:
+            self.index.save(meta)
+
+    async def refresh(self, meta: FileMeta) -> Optional[FileMeta]:
+        key = (meta.chat_id, meta.msg_id)
+        self.log.debug(f'Refreshing the file reference of {key}')
+        self._entries.pop(key, None)
+        try:
+            task = self._refreshing[key]
+        except KeyError:
+            # A lookup that's already running may return the same stale entry from the index,
+            # so it's replaced instead of joined, and later lookups wait for this one
+            task = self._refreshing[key] = self._inflight[key] = asyncio.ensure_future(
+                self._fetch(key, self.peers.input_peer(meta.chat_id), meta.msg_id,
+                            use_index=False))
+        fresh = await asyncio.shield(task)
+        if fresh and meta.thumb_size:
+            return fresh.variant(meta.thumb_size)
+        return fresh
+
+    def invalidate(self, peer: TypeInputPeer, msg_id: int) -> None:
+        key = self.key(peer, msg_id)
+        self.log.debug(f'Invalidating metadata of {key}')
+        self._entries.pop(key, None)
+        self._inflight.pop(key, None)
+        self._refreshing.pop(key, None)
+        if self.index:
+            self.index.delete(key)
@@ -0,0 +1,166 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+from typing import AsyncGenerator, Callable, Dict, Iterator
+
+from aiohttp import web
+from async_generator import aclosing
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+from .config import metrics_dir
+
+# How often each process writes the state of its transfer pipeline when there are several
+publish_interval = 5
+# The live state of every process is added up when scraped, except these which are reported
+# per process
+per_process_gauges = {'tgfilestream_dc_flood_blocked_seconds'}
+
+requests = Counter('tgfilestream_http_requests_total', 'HTTP requests handled',
+                   ['route', 'method', 'status'])
+bytes_served = Counter('tgfilestream_http_response_bytes_total', 'HTTP response body bytes sent',
+                       ['route'])
+part_latency = Histogram('tgfilestream_part_fetch_seconds', 'Time to fetch one file request',
+                         ['dc'])
+connect_latency = Histogram('tgfilestream_connection_setup_seconds',
+                            'Time to open a new MTProto connection', ['dc'])
+auth_export_latency = Histogram('tgfilestream_auth_export_seconds',
+                                'Time to export and import the authorization to a DC', ['dc'])
+get_messages_latency = Histogram('tgfilestream_get_messages_seconds',
+                                 'Time to look up the message of a link')
+hedged_requests = Counter('tgfilestream_hedged_requests_total',
+                          'Slow file requests sent again on another connection, by which copy'
+                          ' answered first', ['dc', 'winner'])
+flood_waits = Counter('tgfilestream_flood_waits_total', 'Flood waits reported by Telegram',
+                      ['dc'])
+cache_lookups = Counter('tgfilestream_cache_lookups_total', 'Cache lookups by outcome',
+                        ['cache', 'result'])
+prefetched_parts = Counter('tgfilestream_prefetched_parts_total',
+                           'File parts fetched ahead of sequential range requests, or skipped'
+                           ' because too much was being prefetched', ['result'])
+startup_duration = Gauge('tgfilestream_startup_seconds', 'Time spent in each startup phase',
+                         ['phase'], multiprocess_mode='liveall')
+
+
+def generate() -> bytes:
+    if not metrics_dir:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def route_name(req: web.Request) -> str:
+    resource = req.match_info.route.resource
+    return resource.canonical if resource else 'unmatched'
+
+
+@web.middleware
+async def metrics_middleware(req: web.Request, handler: Callable) -> web.StreamResponse:
+    try:
+        resp = await handler(req)
+    except web.HTTPException as e:
+        requests.labels(route_name(req), req.method, e.status).inc()
+        raise
+    except Exception:
+        requests.labels(route_name(req), req.method, 500).inc()
+        raise
+    requests.labels(route_name(req), req.method, resp.status).inc()
+    if isinstance(getattr(resp, 'body', None), bytes):
+        bytes_served.labels(route_name(req)).inc(len(resp.body))
+    return resp
+
+
+async def count_bytes(body: AsyncGenerator[bytes, None], route: str
+                      ) -> AsyncGenerator[bytes, None]:
+    counter = bytes_served.labels(route)
+    async with aclosing(body):
+        async for chunk in body:
+            counter.inc(len(chunk))
+            yield chunk
+
+
+# Reports the state of the transfer pipeline whenever the metrics are scraped. With several
+# processes, only the one that gets scraped would be seen, so every process writes its state to
+# gauges that are added up instead.
+class TransferCollector:
+    _gauges: Dict[str, Gauge]
+
+    def __init__(self, transfer, limiter) -> None:
+        self.transfer = transfer
+        self.limiter = limiter
+        self._gauges = {}
+
+    def register(self) -> None:
+        if not metrics_dir:
+            REGISTRY.register(self)
+            return
+        self.transfer.loop.create_task(self._publish_forever())
+
+    def _publish(self) -> None:
+        for family in self.collect():
+            for sample in family.samples:
+                gauge = self._gauges.get(family.name)
+                if gauge is None:
+                    mode = 'liveall' if family.name in per_process_gauges else 'livesum'
+                    gauge = self._gauges[family.name] = Gauge(
+                        family.name, family.documentation, list(sample.labels),
+                        multiprocess_mode=mode, registry=None)
+                (gauge.labels(**sample.labels) if sample.labels else gauge).set(sample.value)
+
+    async def _publish_forever(self) -> None:
+        while True:
+            self._publish()
+            await asyncio.sleep(publish_interval)
+
+    def collect(self) -> Iterator:
+        streams = GaugeMetricFamily('tgfilestream_active_streams',
+                                    'File downloads currently being streamed')
+        streams.add_metric([], self.limiter.active_streams)
+        yield streams
+
+        connections = GaugeMetricFamily('tgfilestream_dc_connections',
+                                        'Pooled MTProto connections', labels=['dc'])
+        in_use = GaugeMetricFamily('tgfilestream_dc_connections_in_use',
+                                   'Pooled MTProto connections with requests in flight',
+                                   labels=['dc'])
+        request_rate = GaugeMetricFamily('tgfilestream_dc_request_rate',
+                                         'Current file request rate limit', labels=['dc'])
+        blocked = GaugeMetricFamily('tgfilestream_dc_flood_blocked_seconds',
+                                    'Remaining flood wait', labels=['dc'])
+        queued = GaugeMetricFamily('tgfilestream_dc_queued_requests',
+                                   'File requests waiting in the fair queue', labels=['dc'])
+        for dc_id, dcm in self.transfer.dc_managers.items():
+            dc = str(dc_id)
+            connections.add_metric([dc], len(dcm.connections))
+            in_use.add_metric([dc], sum(1 for conn in dcm.connections if conn.users > 0))
+            state = dcm.governor.state()
+            request_rate.add_metric([dc], state['rate'])
+            blocked.add_metric([dc], state['blocked_for'])
+            queued.add_metric([dc], dcm.scheduler.queued)
+        yield connections
+        yield in_use
+        yield request_rate
+        yield blocked
+        yield queued
+
+        cache_bytes = GaugeMetricFamily('tgfilestream_cache_bytes', 'Bytes held by part caches',
+                                        labels=['cache'])
+        cache_bytes.add_metric(['memory'], self.transfer.mem_cache.size)
+        if self.transfer.disk_cache:
+            cache_bytes.add_metric(['disk'], self.transfer.disk_cache.size)
+        yield cache_bytes
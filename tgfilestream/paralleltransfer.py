@@ -15,25 +15,74 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
 import logging
-import math
+import os
+import random
+import time
 from async_generator import asynccontextmanager
+from collections import deque
+from copy import copy
 from dataclasses import dataclass
-from typing import Union, AsyncGenerator, AsyncContextManager, Dict, Optional, List
+from functools import partial
+from typing import (Union, AsyncGenerator, AsyncContextManager, Awaitable, Callable, Dict,
+                    Iterator, Optional, List, Deque, Tuple)
 
-from telethon import TelegramClient, utils
+from telethon import TelegramClient, helpers, utils
 from telethon.crypto import AuthKey
-from telethon.errors import DcIdInvalidError
+from telethon.errors import BadRequestError, DcIdInvalidError, FloodError, UnauthorizedError
 from telethon.network import MTProtoSender
+from telethon.tl.functions import PingRequest
 from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
-from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.functions.upload import GetFileRequest, SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.functions.users import GetUsersRequest
+from telethon.tl.tlobject import TLObject, TLRequest
 from telethon.tl.types import (Document, InputFileLocation, InputDocumentFileLocation,
-                               InputPhotoFileLocation, InputPeerPhotoFileLocation, DcOption)
+                               InputPhotoFileLocation, InputPeerPhotoFileLocation, DcOption,
+                               InputUserSelf, InputFile, InputFileBig)
 
-from .config import connection_limit
+from .config import (connection_limit, worker_connection_limit, download_prefetch, disk_cache_dir, disk_cache_size,
+                     memory_cache_size, min_connections, connection_idle_timeout, ping_interval,
+                     max_flood_wait, persist_dc_auth, workers, worker_index, session_file,
+                     stream_read_ahead, upload_parallel, requests_per_connection,
+                     hedge_requests, sequential_prefetch, sequential_prefetch_total)
+from .authstore import AuthKeyStore
+from .diskcache import DiskPartCache
+from .governor import RateGovernor
+from .hedge import HedgePolicy
+from .scheduler import FairScheduler, Flow
+from . import metrics, trace
+from .memcache import MemoryPartCache
+from .readahead import SequentialReads
 
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
 
+# Telegram requires GetFileRequest limits to be a power of two between 4 KiB and 1 MiB, and
+# requests must not cross a 1 MiB boundary, which holds when the offset is divisible by the limit
+min_request_size = 4 * 1024
+max_request_size = 1024 * 1024
+# Downloaded parts are cached and shared between streams on this grid
+part_size = 512 * 1024
+# The size of the first request of a stream, doubled for each following request up to part_size
+initial_request_size = 64 * 1024
+# Uploaded parts must divide 512 KiB, files above 10 MiB have to be uploaded as big files, and
+# no file may have more than 4000 parts
+upload_part_size = 512 * 1024
+big_file_size = 10 * 1024 * 1024
+max_upload_parts = 4000
+max_upload_size = upload_part_size * max_upload_parts
+
+# Connection statistics start from these until the first samples arrive
+default_rtt = 0.2
+default_throughput = 1024 * 1024
+# Responses at least this big are used to estimate throughput, smaller ones to estimate RTT
+throughput_sample_size = 64 * 1024
+ewma_weight = 0.2
+# How long a ping may take before the connection is considered dead
+ping_timeout = 10
+max_backoff = 60
+# How many times a request is retried after flood waits before giving up
+max_flood_retries = 5
+
 root_log = logging.getLogger(__name__)
 
 if connection_limit > 25:
@@ -41,12 +90,45 @@ if connection_limit > 25:
                      ' infinite disconnect/reconnect loops')
 
 
+# Telethon has no error classes for these, they arrive as plain BadRequestErrors
+def is_file_reference_error(error: BaseException) -> bool:
+    return (isinstance(error, BadRequestError)
+            and error.message in ('FILE_REFERENCE_EXPIRED', 'FILE_REFERENCE_INVALID'))
+
+
+# The position and size of a file request, which decide its place in the fair queue
+def request_span(request: TLRequest) -> Tuple[int, int]:
+    if isinstance(request, GetFileRequest):
+        return request.offset, request.limit
+    elif isinstance(request, (SaveFilePartRequest, SaveBigFilePartRequest)):
+        return request.file_part * upload_part_size, len(request.bytes)
+    return 0, 0
+
+
 @dataclass
 class Connection:
     log: logging.Logger
     sender: MTProtoSender
     lock: asyncio.Lock
     users: int = 0
+    ready: bool = False
+    # Estimated round trip time in seconds and transfer rate in bytes per second
+    rtt: float = default_rtt
+    throughput: float = default_throughput
+    # The number of bytes requested over this connection that haven't arrived yet
+    inflight: int = 0
+    last_used: float = 0
+
+    def estimate(self, size: int) -> float:
+        # When a new request of this size would finish if it was sent now
+        return self.rtt + (self.inflight + size) / self.throughput
+
+    def record(self, duration: float, size: int) -> None:
+        if size < throughput_sample_size:
+            self.rtt += (duration - self.rtt) * ewma_weight
+        else:
+            rate = size / max(duration - self.rtt, duration / 2)
+            self.throughput += (rate - self.throughput) * ewma_weight
 
 
 class DCConnectionManager:
@@ -57,73 +139,339 @@ class DCConnectionManager:
     dc_id: int
     dc: Optional[DcOption]
     auth_key: Optional[AuthKey]
+    # Whether auth_key is known to be authorized, keys restored from the store are checked first
+    auth_verified: bool
+    auth_store: Optional[AuthKeyStore]
     connections: List[Connection]
+    governor: RateGovernor
+    scheduler: FairScheduler
+    hedge: HedgePolicy
+    # Whether min_connections are kept open, only for the home DC and DCs files were served from
+    warm: bool
 
     _list_lock: asyncio.Lock
+    _connect_lock: asyncio.Lock
+    _counter: int
+    _backoff: float
+    _connecting: Optional[asyncio.Future]
+    # Counts the exports, so requests that were rejected by the same key only export it once
+    _exports: int
 
-    def __init__(self, client: TelegramClient, dc_id: int) -> None:
+    def __init__(self, client: TelegramClient, dc_id: int,
+                 auth_store: Optional[AuthKeyStore] = None) -> None:
         self.log = root_log.getChild(f'dc{dc_id}')
         self.client = client
         self.dc_id = dc_id
         self.auth_key = None
+        self.auth_verified = False
+        self.auth_store = auth_store
         self.connections = []
+        self.governor = RateGovernor(self.log)
+        self.scheduler = FairScheduler(worker_connection_limit * requests_per_connection)
+        self.hedge = HedgePolicy()
+        self.warm = False
         self._list_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+        self._counter = 0
+        self._backoff = 0
+        self._connecting = None
+        self._exports = 0
         self.loop = client.loop
         self.dc = None
 
     async def _new_connection(self) -> Connection:
         if not self.dc:
             self.dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, self.loop, loggers=self.client._log)
-        index = len(self.connections) + 1
-        conn = Connection(sender=sender, log=self.log.getChild(f'conn{index}'), lock=asyncio.Lock())
+        if not self.auth_key and self.auth_store:
+            # Another worker process may have exported the authorization already
+            key = self.auth_store.get(self.dc_id)
+            if key:
+                self.auth_key = AuthKey(key)
+        sender = MTProtoSender(self.auth_key, self.loop, loggers=self.client._log,
+                               auth_key_callback=self._auth_key_changed)
+        self._counter += 1
+        self.warm = True
+        conn = Connection(sender=sender, log=self.log.getChild(f'conn{self._counter}'),
+                          lock=asyncio.Lock(), last_used=time.monotonic())
         self.connections.append(conn)
         async with conn.lock:
-            conn.log.info("Connecting...")
-            connection_info = self.client._connection(self.dc.ip_address, self.dc.port, self.dc.id,
-                                                      loop=self.loop, loggers=self.client._log,
-                                                      proxy=self.client._proxy)
-            await sender.connect(connection_info)
-            if not self.auth_key:
-                await self._export_auth_key(conn)
+            try:
+                # Connections are set up one at a time so the auth is only exported once
+                async with self._connect_lock:
+                    conn.log.info("Connecting...")
+                    start = time.monotonic()
+                    connection_info = self.client._connection(self.dc.ip_address, self.dc.port,
+                                                              self.dc.id, loop=self.loop,
+                                                              loggers=self.client._log,
+                                                              proxy=self.client._proxy)
+                    await sender.connect(connection_info)
+                    metrics.connect_latency.labels(self.dc_id).observe(time.monotonic() - start)
+                    trace.record('connect', start, dc=self.dc_id)
+                    if not self.auth_key:
+                        await self._export_auth_key(conn)
+                    elif not self.auth_verified:
+                        await self._verify_auth_key(conn)
+            except BaseException:
+                self.connections.remove(conn)
+                await sender.disconnect()
+                raise
+            conn.ready = True
             return conn
 
     async def _export_auth_key(self, conn: Connection) -> None:
         self.log.info(f'Exporting auth to DC {self.dc.id}'
                       f' (main client is in {self.client.session.dc_id})')
+        start = time.monotonic()
         try:
             auth = await self.client(ExportAuthorizationRequest(self.dc.id))
         except DcIdInvalidError:
             self.log.debug('Got DcIdInvalidError')
             self.auth_key = self.client.session.auth_key
+            self.auth_verified = True
             conn.sender.auth_key = self.auth_key
             return
         req = self.client._init_with(ImportAuthorizationRequest(
             id=auth.id, bytes=auth.bytes
         ))
         await conn.sender.send(req)
+        metrics.auth_export_latency.labels(self.dc_id).observe(time.monotonic() - start)
+        trace.record('auth_export', start, dc=self.dc_id)
         self.auth_key = conn.sender.auth_key
+        self.auth_verified = True
+        self._exports += 1
+        if self.auth_store:
+            self.auth_store.save(self.dc_id, self.auth_key.key)
 
-    async def _next_connection(self) -> Connection:
-        best_conn: Optional[Connection] = None
-        for conn in self.connections:
-            if not best_conn or conn.users < best_conn.users:
-                best_conn = conn
-        if (not best_conn or best_conn.users > 0) and len(self.connections) < connection_limit:
-            best_conn = await self._new_connection()
-        return best_conn
+    async def _reauthorize(self, exports: int) -> None:
+        async with self.get_connection() as conn:
+            async with self._connect_lock:
+                if self._exports != exports:
+                    # Another request already exported it again
+                    return
+                self.log.info('Auth was rejected, exporting it again')
+                await self._export_auth_key(conn)
+
+    async def _verify_auth_key(self, conn: Connection) -> None:
+        try:
+            with trace.span('auth_verify', dc=self.dc_id):
+                await conn.sender.send(self.client._init_with(GetUsersRequest([InputUserSelf()])))
+        except UnauthorizedError:
+            self.log.info('Stored auth is no longer valid')
+            if self.auth_store:
+                self.auth_store.delete(self.dc_id)
+            await self._export_auth_key(conn)
+            return
+        self.log.debug('Stored auth is valid')
+        self.auth_verified = True
+
+    def _auth_key_changed(self, auth_key: Optional[AuthKey]) -> None:
+        # The sender generated a new key because the server didn't recognize the old one
+        self.auth_verified = False
+        if self.auth_store and self.dc_id != self.client.session.dc_id:
+            self.auth_store.delete(self.dc_id)
+
+    async def _drop(self, conn: Connection) -> None:
+        # Callers that already hold the connection check this before using it
+        conn.ready = False
+        if conn in self.connections:
+            self.connections.remove(conn)
+            conn.log.info('Disconnecting')
+        await conn.sender.disconnect()
+
+    def _grow(self) -> None:
+        # Open another connection in the background so nobody has to wait for it
+        if self._connecting and not self._connecting.done():
+            return
+        self._connecting = self.loop.create_task(self._new_connection())
+        self._connecting.add_done_callback(self._grow_done)
+
+    def _grow_done(self, task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception():
+            self.log.warning('Failed to open a new connection', exc_info=task.exception())
+
+    async def _next_connection(self, size: int, exclude: Optional[Connection] = None
+                               ) -> Connection:
+        ready = [conn for conn in self.connections if conn.ready and conn is not exclude]
+        best_conn = min(ready, key=lambda conn: conn.estimate(size), default=None)
+        if best_conn and best_conn.users > 0 and len(self.connections) < worker_connection_limit:
+            self._grow()
+        if best_conn:
+            return best_conn
+        if exclude:
+            # Hedges don't wait for a connection to be set up, the caller gives up on them instead
+            if len(self.connections) < worker_connection_limit:
+                self._grow()
+            return exclude
+        if self.connections:
+            # Every connection is still being set up, wait for the one that started first
+            return self.connections[0]
+        return await self._new_connection()
 
     @asynccontextmanager
-    async def get_connection(self) -> AsyncContextManager[Connection]:
+    async def get_connection(self, size: int = 0, exclude: Optional[Connection] = None
+                             ) -> AsyncContextManager[Connection]:
+        waited = time.monotonic()
         async with self._list_lock:
-            conn: Connection = await asyncio.shield(self._next_connection())
-            # The connection is locked so reconnections don't stack
-            async with conn.lock:
-                conn.users += 1
+            trace.record('list_lock', waited, dc=self.dc_id)
+            with trace.span('connection', dc=self.dc_id):
+                conn: Connection = await asyncio.shield(self._next_connection(size, exclude))
+                # The connection is locked so reconnections don't stack
+                async with conn.lock:
+                    conn.users += 1
         try:
             yield conn
         finally:
             conn.users -= 1
+            conn.last_used = time.monotonic()
+
+    async def send(self, request: TLRequest, flow: Optional[Flow] = None) -> TLObject:
+        attempt = 0
+        reconnected = False
+        reauthorized = False
+        offset, cost = request_span(request)
+        while True:
+            exports = self._exports
+            queued = time.monotonic()
+            async with self.scheduler.slot(flow, cost, offset):
+                trace.record('queue', queued, dc=self.dc_id)
+                with trace.span('throttle', dc=self.dc_id):
+                    await self.governor.acquire()
+                try:
+                    return await self._send(request)
+                except FloodError as e:
+                    seconds = getattr(e, 'seconds', 1)
+                    metrics.flood_waits.labels(self.dc_id).inc()
+                    self.governor.penalize(seconds)
+                    attempt += 1
+                    if attempt > max_flood_retries or seconds > max_flood_wait:
+                        raise
+                except ConnectionError:
+                    # The connection was dropped, so the retry goes to another one
+                    if reconnected:
+                        raise
+                    reconnected = True
+                    self.log.debug(f'Retrying {type(request).__name__} on another connection')
+                    continue
+                except UnauthorizedError:
+                    # Telegram dropped the key and the sender made a new, unauthorized one in its
+                    # place. The connections of a DC share their key, so exporting the
+                    # authorization on one of them fixes them all.
+                    if reauthorized or self.dc_id == self.client.session.dc_id:
+                        raise
+                    reauthorized = True
+                    await self._reauthorize(exports)
+                    continue
+            self.log.debug(f'Retrying {type(request).__name__} after flood wait'
+                           f' (attempt {attempt})')
+
+    async def _send_on(self, conn: Connection, request: TLRequest, size: int) -> TLObject:
+        if not conn.ready:
+            raise ConnectionError('Connection was closed while it was being set up')
+        start = time.monotonic()
+        conn.inflight += size
+        try:
+            result = await conn.sender.send(request)
+        except ConnectionError:
+            # The sender gave up reconnecting, stop handing it out
+            await self._drop(conn)
+            raise
+        finally:
+            conn.inflight -= size
+            offset, limit = request_span(request)
+            trace.record('part', start, dc=self.dc_id, conn=conn.log.name.rsplit('.', 1)[-1],
+                         offset=offset, limit=limit)
+        duration = time.monotonic() - start
+        conn.record(duration, len(getattr(result, 'bytes', b'')))
+        metrics.part_latency.labels(self.dc_id).observe(duration)
+        self.hedge.record(duration)
+        return result
+
+    async def _send(self, request: TLRequest) -> TLObject:
+        size = getattr(request, 'limit', 0)
+        async with self.get_connection(size) as conn:
+            if not hedge_requests or not isinstance(request, GetFileRequest):
+                return await self._send_on(conn, request, size)
+            self.hedge.earn()
+            primary = self.loop.create_task(self._send_on(conn, request, size))
+            try:
+                done, _ = await asyncio.wait([primary], timeout=self.hedge.delay)
+                if done or not self.hedge.spend():
+                    return await primary
+                return await self._send_hedged(primary, conn, request, size)
+            finally:
+                primary.cancel()
+
+    async def _send_hedged(self, primary: asyncio.Task, conn: Connection, request: TLRequest,
+                           size: int) -> TLObject:
+        async with self.get_connection(size, exclude=conn) as other:
+            if other is conn or not other.ready:
+                return await primary
+            conn.log.debug(f'No response in {self.hedge.delay:.3f} seconds,'
+                           f' sending the request again on {other.log.name}')
+            hedge = self.loop.create_task(self._send_on(other, request, size))
+            hedged = time.monotonic()
+            try:
+                done, _ = await asyncio.wait([primary, hedge],
+                                             return_when=asyncio.FIRST_COMPLETED)
+                first, second = (primary, hedge) if primary in done else (hedge, primary)
+                if not first.exception():
+                    winner = 'hedge' if first is hedge else 'primary'
+                    metrics.hedged_requests.labels(self.dc_id, winner).inc()
+                    trace.record('hedge', hedged, dc=self.dc_id, winner=winner)
+                    return first.result()
+                # Use the other copy if the first one to finish failed
+                return await second
+            finally:
+                hedge.cancel()
+
+    async def _ping(self, conn: Connection) -> None:
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(conn.sender.send(PingRequest(
+                ping_id=random.randrange(-2 ** 63, 2 ** 63))), ping_timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            conn.log.warning('Ping failed, dropping connection')
+            await self._drop(conn)
+            return
+        conn.record(time.monotonic() - start, 0)
+
+    async def _maintain_once(self) -> None:
+        now = time.monotonic()
+        pings = []
+        for conn in list(self.connections):
+            if not conn.ready or conn.users > 0:
+                continue
+            if (now - conn.last_used > connection_idle_timeout
+                    and len(self.connections) > (min_connections if self.warm else 0)):
+                conn.log.debug('Closing idle connection')
+                await self._drop(conn)
+            else:
+                pings.append(self._ping(conn))
+        await asyncio.gather(*pings)
+        while self.warm and len(self.connections) < min_connections:
+            try:
+                await self._new_connection()
+            except Exception:
+                # Only the first failure in a row is worth a warning
+                log = self.log.debug if self._backoff else self.log.warning
+                self._backoff = min(max(self._backoff * 2, 1), max_backoff)
+                log(f'Failed to open a warm connection, retrying in {self._backoff} seconds',
+                    exc_info=True)
+                return
+            self._backoff = 0
+
+    async def maintain(self) -> None:
+        while True:
+            try:
+                await self._maintain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception('Error while maintaining connections')
+            await asyncio.sleep(self._backoff or ping_interval)
+
+    async def stop(self) -> None:
+        await asyncio.gather(*[self._drop(conn) for conn in list(self.connections)])
 
 
 class ParallelTransferrer:
@@ -132,68 +480,354 @@ class ParallelTransferrer:
     loop: asyncio.AbstractEventLoop
 
     dc_managers: Dict[int, DCConnectionManager]
+    auth_store: Optional[AuthKeyStore]
+    maintenance: List[asyncio.Future]
+    disk_cache: Optional[DiskPartCache]
+    mem_cache: MemoryPartCache
+    sequential: SequentialReads
 
     _counter: int
+    _prefetching: int
 
     def __init__(self, client: TelegramClient) -> None:
         self.client = client
         self.loop = self.client.loop
         self._counter = 0
+        self.auth_store = (AuthKeyStore.for_session(client.session,
+                                                    session_file if worker_index else None)
+                           if persist_dc_auth else None)
         self.dc_managers = {
-            1: DCConnectionManager(client, 1),
-            2: DCConnectionManager(client, 2),
-            3: DCConnectionManager(client, 3),
-            4: DCConnectionManager(client, 4),
-            5: DCConnectionManager(client, 5),
+            1: DCConnectionManager(client, 1, self.auth_store),
+            2: DCConnectionManager(client, 2, self.auth_store),
+            3: DCConnectionManager(client, 3, self.auth_store),
+            4: DCConnectionManager(client, 4, self.auth_store),
+            5: DCConnectionManager(client, 5, self.auth_store),
         }
+        self.disk_cache = None
+        if disk_cache_dir:
+            # Each worker keeps its own share of the cache in its own directory, so they never
+            # evict or clean up each other's files
+            cache_dir = (os.path.join(disk_cache_dir, f'worker{worker_index}') if worker_index
+                         else disk_cache_dir)
+            self.disk_cache = DiskPartCache(cache_dir, disk_cache_size // workers, self.loop)
+        self.mem_cache = MemoryPartCache(memory_cache_size // workers, self.loop)
+        self.sequential = SequentialReads()
+        self._prefetching = 0
+        self.maintenance = []
+
+    def set_home_dc(self) -> DCConnectionManager:
+        home_key = self.client.session.auth_key
+        for dcm in self.dc_managers.values():
+            # The session moved to another DC, the old one needs an exported key instead
+            if dcm.auth_key and dcm.auth_key.key == home_key.key:
+                dcm.auth_key = None
+                dcm.auth_verified = False
+        home_dc = self.dc_managers[self.client.session.dc_id]
+        home_dc.auth_key = self.client.session.auth_key
+        home_dc.auth_verified = True
+        # The other DCs only get connections once something is downloaded from them
+        home_dc.warm = True
+        return home_dc
 
     def post_init(self) -> None:
-        self.dc_managers[self.client.session.dc_id].auth_key = self.client.session.auth_key
+        home_dc = self.set_home_dc()
+        if self.auth_store:
+            for dc_id, key in self.auth_store.load().items():
+                if dc_id in self.dc_managers and dc_id != home_dc.dc_id:
+                    self.log.debug(f'Restored stored auth for DC {dc_id}')
+                    self.dc_managers[dc_id].auth_key = AuthKey(key)
+        if self.disk_cache:
+            self.disk_cache.load()
+        # Warm up the connection pools and keep them healthy in the background
+        self.maintenance = [self.loop.create_task(dcm.maintain())
+                            for dcm in self.dc_managers.values()]
+
+    async def stop(self) -> None:
+        for task in self.maintenance:
+            task.cancel()
+        await asyncio.gather(*[dcm.stop() for dcm in self.dc_managers.values()])
 
     @property
     def next_index(self) -> int:
         self._counter += 1
         return self._counter
 
-    async def _int_download(self, request: GetFileRequest, first_part: int, last_part: int,
-                            part_count: int, part_size: int, dc_id: int, first_part_cut: int,
-                            last_part_cut: int) -> AsyncGenerator[bytes, None]:
+    @staticmethod
+    def _cache_key(location: TypeLocation) -> Optional[str]:
+        file_id = getattr(location, 'id', None)
+        if file_id is None:
+            return None
+        kind = 'photo' if isinstance(location, InputPhotoFileLocation) else 'doc'
+        thumb_size = getattr(location, 'thumb_size', '')
+        return f'{kind}{file_id}_{thumb_size}' if thumb_size else f'{kind}{file_id}'
+
+    @staticmethod
+    async def _fetch(dcm: DCConnectionManager, location: TypeLocation, offset: int, limit: int,
+                     flow: Flow) -> bytes:
+        result = await dcm.send(GetFileRequest(location, offset=offset, limit=limit), flow)
+        return result.bytes
+
+    async def _load_parts(self, dcm: DCConnectionManager, location: TypeLocation, cache_key: str,
+                          parts: List[int], flow: Flow) -> List[bytes]:
+        if self.disk_cache:
+            metrics.cache_lookups.labels('disk', 'miss').inc(len(parts))
+        data = await self._fetch(dcm, location, parts[0] * part_size, len(parts) * part_size,
+                                 flow)
+        chunks = [data[index * part_size:(index + 1) * part_size] for index in range(len(parts))]
+        if self.disk_cache:
+            for part, chunk in zip(parts, chunks):
+                self.disk_cache.write(cache_key, part, chunk)
+        return chunks
+
+    def _get_parts(self, dcm: DCConnectionManager, location: TypeLocation, cache_key: str,
+                   parts: List[int], flow: Flow) -> List[asyncio.Future]:
+        data = self.mem_cache.get(cache_key, parts[0])
+        if data is not None:
+            metrics.cache_lookups.labels('memory', 'hit').inc()
+            future = self.loop.create_future()
+            future.set_result(data)
+            return [future]
+        future = self.mem_cache.pending(cache_key, parts[0])
+        if future:
+            metrics.cache_lookups.labels('memory', 'coalesced').inc()
+            futures = [future]
+        else:
+            metrics.cache_lookups.labels('memory', 'miss').inc(len(parts))
+            futures = self.mem_cache.load(cache_key, parts,
+                                          partial(self._load_parts, dcm, location, cache_key, parts,
+                                                  flow))
+        # Shield the shared fetches so one reader going away doesn't cancel them for the others
+        return [asyncio.shield(future) for future in futures]
+
+    async def _read_part(self, dcm: DCConnectionManager, location: TypeLocation, cache_key: str,
+                         part: int, flow: Flow) -> bytes:
+        # Parts on disk skip the memory cache, they're written out of the mapped file and the
+        # page cache already keeps the hot ones in memory
+        metrics.cache_lookups.labels('memory', 'miss').inc()
+        with trace.span('disk_read', part=part):
+            data = await self.disk_cache.read(cache_key, part)
+        if data is not None:
+            metrics.cache_lookups.labels('disk', 'hit').inc()
+            return data
+        future, = self._get_parts(dcm, location, cache_key, [part], flow)
+        return await future
+
+    def _ramp_part(self, dcm: DCConnectionManager, location: TypeLocation, cache_key: str,
+                   part: int, requests: List[Tuple[int, int]], flow: Flow
+                   ) -> List[asyncio.Future]:
+        tasks = [self.loop.create_task(self._fetch(dcm, location, offset, limit, flow))
+                 for offset, limit in requests]
+
+        async def assemble() -> List[bytes]:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            data = b''.join(results)
+            if self.disk_cache:
+                self.disk_cache.write(cache_key, part, data)
+            return [data]
+
+        # Other streams reading the same part wait for the assembled part instead of fetching it
+        self.mem_cache.load(cache_key, [part], assemble)
+        return [asyncio.shield(task) for task in tasks]
+
+    def _is_cached(self, cache_key: Optional[str], part: int) -> bool:
+        return bool(cache_key) and (self.mem_cache.has(cache_key, part) or bool(
+            self.disk_cache and self.disk_cache.contains(cache_key, part)))
+
+    def _plan(self, dcm: DCConnectionManager, location: TypeLocation, offset: int, limit: int,
+              file_size: int, flow: Flow) -> Iterator[Tuple[asyncio.Future, int]]:
+        cache_key = self._cache_key(location)
+        pos = offset
+        size = initial_request_size
+        while pos < limit:
+            part = pos // part_size
+            part_start = part * part_size
+            part_end = min(part_start + part_size, file_size)
+            if self._is_cached(cache_key, part):
+                if self.mem_cache.has(cache_key, part):
+                    future, = self._get_parts(dcm, location, cache_key, [part], flow)
+                else:
+                    future = self.loop.create_task(self._read_part(dcm, location, cache_key, part,
+                                                                   flow))
+                yield future, part_start
+                pos = part_end
+                # Cached parts already get the first bytes out, so there's no need to ramp up
+                size = part_size
+                continue
+            if pos == part_start and size >= part_size:
+                if not cache_key:
+                    yield (self.loop.create_task(self._fetch(dcm, location, pos, part_size, flow)),
+                           pos)
+                    pos = part_end
+                    continue
+                parts = [part]
+                if (part_start % max_request_size == 0 and limit > part_start + part_size
+                        and not self._is_cached(cache_key, part + 1)):
+                    parts.append(part + 1)
+                for part, future in zip(parts, self._get_parts(dcm, location, cache_key, parts, flow)):
+                    yield future, part * part_size
+                pos = min(part_start + len(parts) * part_size, file_size)
+                continue
+
+            # Ramp up with small aligned requests inside the part to get the first bytes out fast
+            need_end = min(limit, part_end)
+            requests = []
+            while pos < need_end:
+                block = min_request_size
+                while block < size and pos - pos % block + block < need_end:
+                    block *= 2
+                if pos > 0 and (requests or pos % min_request_size == 0):
+                    # Stay aligned to the previous request so no bytes are fetched twice
+                    block = min(block, pos & -pos)
+                start = pos - pos % block
+                requests.append((start, block))
+                pos = start + block
+                size = min(size * 2, part_size)
+            if cache_key and requests[0][0] == part_start and need_end == part_end:
+                futures = self._ramp_part(dcm, location, cache_key, part, requests, flow)
+                for (start, _), future in zip(requests, futures):
+                    yield future, start
+            else:
+                for start, block in requests:
+                    yield (self.loop.create_task(self._fetch(dcm, location, start, block, flow)),
+                           start)
+
+    def _prefetch_done(self, size: int, _: asyncio.Future) -> None:
+        self._prefetching -= size
+
+    def _prefetch(self, dcm: DCConnectionManager, location: TypeLocation, cache_key: str,
+                  offset: int, file_size: int, flow: Flow) -> None:
+        # The parts land in the memory cache, where the next request of the player finds them
+        # or waits for the ones still on their way. They're fetched as part of the stream's
+        # flow, so they queue behind its own requests.
+        end = min(offset + sequential_prefetch, file_size)
+        for part in range(offset // part_size, (end - 1) // part_size + 1):
+            if self._is_cached(cache_key, part):
+                continue
+            size = min(part_size, file_size - part * part_size)
+            if self._prefetching + size > sequential_prefetch_total:
+                metrics.prefetched_parts.labels('over_budget').inc()
+                return
+            self._prefetching += size
+            metrics.prefetched_parts.labels('fetched').inc()
+            future, = self.mem_cache.load(cache_key, [part],
+                                          partial(self._load_parts, dcm, location, cache_key,
+                                                  [part], flow))
+            future.add_done_callback(partial(self._prefetch_done, size))
+
+    async def _int_download(self, location: TypeLocation, dc_id: int, offset: int, limit: int,
+                            file_size: int, prefetch: bool = False
+                            ) -> AsyncGenerator[bytes, None]:
         log = self.log
+        pending: Deque[Tuple[asyncio.Future, int]] = deque()
+        dcm = self.dc_managers[dc_id]
+        # Every stream is its own flow in the DC's fair queue, weighted by the size of the file
+        flow = Flow(file_size, offset)
+        plan = self._plan(dcm, location, offset, limit, file_size, flow)
+        started = time.monotonic()
         try:
-            part = first_part
-            dcm = self.dc_managers[dc_id]
-            async with dcm.get_connection() as conn:
-                log = conn.log
-                while part <= last_part:
-                    result = await conn.sender.send(request)
-                    request.offset += part_size
-                    if part == first_part:
-                        yield result.bytes[first_part_cut:]
-                    elif part == last_part:
-                        yield result.bytes[:last_part_cut]
-                    else:
-                        yield result.bytes
-                    log.debug(f'Part {part}/{last_part} (total {part_count}) downloaded')
-                    part += 1
+            try:
+                planned_all = False
+                while True:
+                    # Keep the prefetch window full, but don't read too far ahead of the client
+                    while (not planned_all and len(pending) < download_prefetch
+                           and (not pending
+                                or pending[-1][1] - pending[0][1] < stream_read_ahead)):
+                        try:
+                            pending.append(next(plan))
+                        except StopIteration:
+                            planned_all = True
+                            if prefetch and limit < file_size:
+                                self._prefetch(dcm, location, self._cache_key(location), limit,
+                                               file_size, flow)
+                    if not pending:
+                        break
+                    future, chunk_start = pending.popleft()
+                    with trace.timed('download_wait'):
+                        data = await future
+                    if started:
+                        trace.record('first_part', started, offset=offset)
+                        started = 0
+                    yield data[max(offset - chunk_start, 0):limit - chunk_start]
+                    log.debug(f'Bytes {chunk_start}-{chunk_start + len(data)}'
+                              f' (total {file_size}) downloaded')
                 log.debug('Parallel download finished')
+            finally:
+                for future, _ in pending:
+                    future.cancel()
+                plan.close()
         except (GeneratorExit, StopAsyncIteration, asyncio.CancelledError):
             log.debug('Parallel download interrupted')
             raise
-        except Exception:
-            log.debug('Parallel download errored', exc_info=True)
+        except Exception as e:
+            if is_file_reference_error(e):
+                # The caller can get a new reference from the message and resume from here
+                log.debug(f'Parallel download stopped by {e.message}')
+            else:
+                log.debug('Parallel download errored', exc_info=True)
+            raise
+
+    async def upload(self, read: Callable[[int], Awaitable[bytes]], file_size: int, name: str
+                     ) -> Union[InputFile, InputFileBig]:
+        if not 0 < file_size <= max_upload_size:
+            raise ValueError(f'Uploads must be between 1 and {max_upload_size} bytes')
+        # Uploaded parts belong to the authorization, so they have to go to the home DC
+        dcm = self.dc_managers[self.client.session.dc_id]
+        file_id = helpers.generate_random_long()
+        part_count = (file_size + upload_part_size - 1) // upload_part_size
+        big = file_size > big_file_size
+        slots = asyncio.Semaphore(upload_parallel)
+        flow = Flow(file_size)
+        log = self.log
+        log.debug(f'Starting parallel upload of {file_size} bytes in {part_count} parts')
+
+        async def save(part: int, data: bytes) -> None:
+            try:
+                if big:
+                    request = SaveBigFilePartRequest(file_id, part, part_count, data)
+                else:
+                    request = SaveFilePartRequest(file_id, part, data)
+                if not await dcm.send(request, flow):
+                    raise RuntimeError(f'Telegram did not save part {part} of the upload')
+            finally:
+                slots.release()
+
+        tasks: List[asyncio.Task] = []
+        try:
+            for part in range(part_count):
+                # Only read the next part once there's room for it, so at most upload_parallel
+                # parts of the file are held in memory
+                await slots.acquire()
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+                data = await read(min(upload_part_size, file_size - part * upload_part_size))
+                tasks.append(self.loop.create_task(save(part, data)))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            log.debug('Parallel upload failed or was interrupted')
+            for task in tasks:
+                task.cancel()
+            raise
+        log.debug('Parallel upload finished')
+        if big:
+            return InputFileBig(file_id, part_count, name)
+        return InputFile(file_id, part_count, name, md5_checksum='')
 
-    def download(self, file: TypeLocation, file_size: int, offset: int, limit: int
+    def download(self, file: TypeLocation, file_size: int, offset: int, limit: int,
+                 thumb_size: str = '', reader: Optional[str] = None
                  ) -> AsyncGenerator[bytes, None]:
         dc_id, location = utils.get_input_location(file)
-        part_size = 512 * 1024
-        first_part_cut = offset % part_size
-        first_part = math.floor(offset / part_size)
-        last_part_cut = part_size - (limit % part_size)
-        last_part = math.ceil(limit / part_size)
-        part_count = math.ceil(file_size / part_size)
-        self.log.debug(f'Starting parallel download: chunks {first_part}-{last_part}'
-                       f' of {part_count} {location!s}')
-        request = GetFileRequest(location, offset=first_part * part_size, limit=part_size)
-
-        return self._int_download(request, first_part, last_part, part_count, part_size, dc_id,
-                                  first_part_cut, last_part_cut)
+        if thumb_size:
+            location = copy(location)
+            location.thumb_size = thumb_size
+        self.log.debug(f'Starting parallel download: bytes {offset}-{limit}'
+                       f' of {file_size} {location!s}')
+        cache_key = self._cache_key(location)
+        # Players that read the file with a chain of range requests get the parts after each
+        # one prefetched
+        prefetch = bool(reader and cache_key and sequential_prefetch
+                        and self.sequential.observe(reader, cache_key, offset, limit))
+        return self._int_download(location, dc_id, offset, limit, file_size, prefetch)
@@ -0,0 +1,135 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import sqlite3
+import time
+from typing import Dict, Optional
+
+from telethon import TelegramClient, utils
+from telethon.errors import RPCError
+from telethon.tl.functions.channels import GetChannelsRequest
+from telethon.tl.functions.users import GetUsersRequest
+from telethon.tl.types import (TypeInputPeer, InputPeerChannel, InputPeerChat, InputPeerUser,
+                               InputChannel, InputUser, PeerChannel, PeerChat)
+
+from .authstore import SessionTable
+from .config import worker_index, session_file
+
+
+class PeerStore(SessionTable):
+    table = 'tgfilestream_peers'
+    columns = 'peer_id integer primary key, access_hash integer, date integer'
+
+    def load(self) -> Dict[int, int]:
+        try:
+            return dict(self._execute(f'select peer_id, access_hash from {self.table}'))
+        except sqlite3.Error:
+            self.log.warning('Failed to load the stored peers', exc_info=True)
+            return {}
+
+    def get(self, peer_id: int) -> Optional[int]:
+        try:
+            rows = self._execute(f'select access_hash from {self.table} where peer_id = ?',
+                                 peer_id)
+        except sqlite3.Error:
+            self.log.warning(f'Failed to look up the stored peer {peer_id}', exc_info=True)
+            return None
+        return rows[0][0] if rows else None
+
+    def save(self, peer_id: int, access_hash: int) -> None:
+        self._write(f'Failed to store the peer {peer_id}',
+                    f'insert or replace into {self.table} values (?, ?, ?)',
+                    peer_id, access_hash, int(time.time()))
+
+    def delete(self, peer_id: int) -> None:
+        self._write(f'Failed to delete the stored peer {peer_id}',
+                    f'delete from {self.table} where peer_id = ?', peer_id)
+
+
+# Remembers the access hashes of the channels and users the bot has seen, so peers decoded from
+# links without one can be used directly instead of making Telegram reject them first.
+class PeerCache:
+    log: logging.Logger = logging.getLogger(__name__)
+    client: TelegramClient
+    store: Optional[PeerStore]
+
+    _hashes: Dict[int, int]
+
+    def __init__(self, client: TelegramClient) -> None:
+        self.client = client
+        self.store = PeerStore.for_session(client.session, session_file if worker_index else None)
+        self._hashes = self.store.load() if self.store else {}
+
+    def remember(self, peer: Optional[TypeInputPeer]) -> None:
+        if not isinstance(peer, (InputPeerChannel, InputPeerUser)) or not peer.access_hash:
+            return
+        peer_id = utils.get_peer_id(peer)
+        if self._hashes.get(peer_id) == peer.access_hash:
+            return
+        self._hashes[peer_id] = peer.access_hash
+        if self.store:
+            self.store.save(peer_id, peer.access_hash)
+
+    def forget(self, peer: TypeInputPeer) -> None:
+        peer_id = utils.get_peer_id(peer)
+        if self._hashes.pop(peer_id, None) is not None and self.store:
+            self.store.delete(peer_id)
+
+    def resolve(self, peer: TypeInputPeer) -> TypeInputPeer:
+        if not isinstance(peer, (InputPeerChannel, InputPeerUser)) or peer.access_hash:
+            return peer
+        peer_id = utils.get_peer_id(peer)
+        access_hash = self._hashes.get(peer_id)
+        if access_hash is None and self.store:
+            # The main process may have seen the peer after this worker started
+            access_hash = self.store.get(peer_id)
+            if access_hash:
+                self._hashes[peer_id] = access_hash
+        if not access_hash:
+            return peer
+        if isinstance(peer, InputPeerChannel):
+            return InputPeerChannel(channel_id=peer.channel_id, access_hash=access_hash)
+        return InputPeerUser(user_id=peer.user_id, access_hash=access_hash)
+
+    def input_peer(self, peer_id: int) -> TypeInputPeer:
+        real_id, peer_type = utils.resolve_id(peer_id)
+        if peer_type is PeerChannel:
+            return self.resolve(InputPeerChannel(channel_id=real_id, access_hash=0))
+        elif peer_type is PeerChat:
+            return InputPeerChat(chat_id=real_id)
+        return self.resolve(InputPeerUser(user_id=real_id, access_hash=0))
+
+    async def refresh(self, peer: TypeInputPeer) -> Optional[TypeInputPeer]:
+        self.forget(peer)
+        try:
+            if isinstance(peer, InputPeerChannel):
+                result = await self.client(GetChannelsRequest([
+                    InputChannel(channel_id=peer.channel_id, access_hash=0)]))
+                entity = result.chats[0] if result.chats else None
+            elif isinstance(peer, InputPeerUser):
+                result = await self.client(GetUsersRequest([
+                    InputUser(user_id=peer.user_id, access_hash=0)]))
+                entity = result[0] if result else None
+            else:
+                return None
+        except RPCError as e:
+            self.log.debug(f'Failed to refresh the access hash of {utils.get_peer_id(peer)}: {e}')
+            return None
+        if not entity:
+            return None
+        fresh = utils.get_input_peer(entity)
+        self.remember(fresh)
+        return fresh
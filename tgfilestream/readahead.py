@@ -0,0 +1,47 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+# A request is a continuation of the previous one of the same client if it starts at most this
+# many bytes before or after where the previous one ended
+max_gap = 512 * 1024
+# How long and for how many client and file pairs the end of the last request is remembered
+reader_ttl = 60
+max_readers = 4096
+
+ReaderKey = Tuple[str, str]
+
+
+# Tells players reading a file front to back with a chain of range requests apart from ones
+# seeking around, so only the former get the next parts fetched before asking for them
+class SequentialReads:
+    _ends: 'OrderedDict[ReaderKey, Tuple[int, float]]'
+
+    def __init__(self) -> None:
+        self._ends = OrderedDict()
+
+    def observe(self, reader: str, key: str, offset: int, limit: int) -> bool:
+        now = time.monotonic()
+        previous = self._ends.pop((reader, key), None)
+        self._ends[(reader, key)] = (limit, now)
+        while len(self._ends) > max_readers:
+            self._ends.popitem(last=False)
+        if not previous:
+            return False
+        end, seen = previous
+        return now - seen < reader_ttl and end - max_gap <= offset <= end + max_gap
@@ -0,0 +1,104 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
+import itertools
+from typing import AsyncContextManager, Iterator, List, Optional, Tuple
+
+from async_generator import asynccontextmanager
+
+# Files of this size get the base weight, smaller files get proportionally more up to max_weight
+reference_size = 16 * 1024 * 1024
+max_weight = 16
+# The first bytes of every stream are weighted up, they decide the time to first byte
+first_bytes = 512 * 1024
+first_bytes_boost = 4
+
+
+# The share of a DC one stream or upload gets while other requests are waiting
+class Flow:
+    weight: float
+    offset: int
+    finish: float
+
+    def __init__(self, file_size: int = reference_size, offset: int = 0) -> None:
+        self.weight = min(max(reference_size / max(file_size, 1), 1), max_weight)
+        self.offset = offset
+        self.finish = 0
+
+    def request_weight(self, offset: int) -> float:
+        if offset - self.offset < first_bytes:
+            return self.weight * first_bytes_boost
+        return self.weight
+
+
+# Start-time fair queueing of the requests to one DC. Only capacity requests are in flight at
+# once, and waiting requests are let through in the order of their virtual finish time, so the
+# requests of small files and the first requests of streams overtake long transfers instead of
+# queueing behind them.
+class FairScheduler:
+    capacity: int
+    active: int
+    vtime: float
+
+    _queue: List[Tuple[float, int, asyncio.Future, float]]
+    _counter: Iterator[int]
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.active = 0
+        self.vtime = 0
+        self._queue = []
+        self._counter = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future, _ in self._queue if not future.done())
+
+    @asynccontextmanager
+    async def slot(self, flow: Optional[Flow], cost: int, offset: int = 0
+                   ) -> AsyncContextManager[None]:
+        flow = flow or Flow()
+        start = max(self.vtime, flow.finish)
+        finish = start + cost / flow.request_weight(offset)
+        flow.finish = finish
+        if self.active < self.capacity and not self._queue:
+            self.active += 1
+            self.vtime = start
+        else:
+            future = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._queue, (finish, next(self._counter), future, start))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # The slot was handed over just before the request was cancelled
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self.active -= 1
+        while self._queue and self.active < self.capacity:
+            _, _, future, start = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self.active += 1
+            self.vtime = max(self.vtime, start)
+            future.set_result(None)
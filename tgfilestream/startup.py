@@ -0,0 +1,78 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from .config import use_uvloop
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# The event loop policy has to be set before anything creates the loop, so this module is imported
+# by the entry points before the Telegram client
+if use_uvloop:
+    try:
+        import uvloop
+    except ImportError:
+        log.warning('USE_UVLOOP is set, but uvloop is not installed')
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def process_start_time() -> float:
+    # Count from the start of the process where possible so interpreter startup and the imports
+    # before this module are included
+    try:
+        with open('/proc/self/stat') as file:
+            start_ticks = int(file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+        return time.monotonic() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+# Records how long each startup phase took, reported once the server is ready
+class StartupTimer:
+    started: float
+    phases: List[Tuple[str, float]]
+
+    _last: float
+
+    def __init__(self) -> None:
+        self.started = self._last = process_start_time()
+        self.phases = []
+
+    def mark(self, phase: str) -> None:
+        now = time.monotonic()
+        self.phases.append((phase, now - self._last))
+        metrics.startup_duration.labels(phase).set(now - self._last)
+        self._last = now
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def report(self) -> None:
+        metrics.startup_duration.labels('total').set(self.elapsed)
+        phases = ', '.join(f'{phase} {duration:.3f}s' for phase, duration in self.phases)
+        log.info(f'Ready to serve files {self.elapsed:.3f}s after start ({phases})')
+
+
+timer = StartupTimer()
@@ -14,27 +14,79 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.'
 import logging
-from typing import cast
+from typing import Union, cast
 import asyncio
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, functions
+from telethon.errors import ChannelInvalidError, PeerIdInvalidError, UserIdInvalidError
 from telethon.tl.custom import Message
-from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+from telethon.tl.types import InputFile, InputFileBig
+from yarl import URL
 
-from .config import link_prefix, api_id, api_hash, allowed_user, max_file_size, admin_id, session
+from .config import (link_prefix, api_id, api_hash, allowed_user, max_file_size, admin_id, session,
+                     session_file, worker_index, file_index, upload_chat_id)
+from .metacache import FileMetaCache, FileIndex
 from .paralleltransfer import ParallelTransferrer
-from .string_encoder import StringCoder
+from .peercache import PeerCache
+from . import linkid
 from .util import get_file_name, get_media_meta
+from .workers import worker_session
 
 log = logging.getLogger(__name__)
 
-client = TelegramClient(session, api_id, api_hash)
+client = TelegramClient(worker_session(session_file) if worker_index else session, api_id, api_hash)
 transfer = ParallelTransferrer(client)
+peers = PeerCache(client)
+meta_cache = FileMetaCache(client, peers, FileIndex.for_session(
+    client.session, session_file if worker_index else None) if file_index else None)
+# Set once the client is logged in and the transfer engine is ready to serve files
+client_ready = asyncio.Event()
+
+
+async def fix_session_dc() -> None:
+    config = await client(functions.help.GetConfigRequest())
+    # Telethon would otherwise request the config again for the first connection to another DC
+    TelegramClient._config = config
+    for option in config.dc_options:
+        if option.ip_address == client.session.server_address:
+            if (client.session.dc_id, client.session.port) != (option.id, option.port):
+                log.warning(f"Fixed DC ID in session from {client.session.dc_id} to {option.id}")
+                client.session.set_dc(option.id, option.ip_address, option.port)
+                client.session.save()
+                transfer.set_home_dc()
+            break
+
+
+async def make_link_id(evt: Union[Message, events.NewMessage.Event]) -> str:
+    # The access hash of the chat is left out of the link, the peer cache remembers it
+    peers.remember(await evt.get_input_chat())
+    return linkid.encode(evt.chat_id, evt.id)
+
+
+async def make_link(message: Message) -> URL:
+    return link_prefix / await make_link_id(message) / get_file_name(message)
+
+
+async def send_upload(file: Union[InputFile, InputFileBig]) -> Message:
+    peer = peers.input_peer(upload_chat_id)
+    try:
+        return await client.send_file(peer, file, force_document=True)
+    except (ChannelInvalidError, PeerIdInvalidError, UserIdInvalidError):
+        fresh = await peers.refresh(peer)
+        if not fresh:
+            raise
+        return await client.send_file(fresh, file, force_document=True)
 
 
 def new_message_filter(message_text):
     return not str(message_text).startswith('/start')
 
 
+@client.on(events.NewMessage())
+async def remember_peers(evt: events.NewMessage.Event) -> None:
+    peers.remember(evt.input_chat)
+    peers.remember(evt.input_sender)
+
+
 @client.on(events.NewMessage(pattern='/start'))
 async def handle_start(evt: events.NewMessage.Event) -> None:
     c = await evt.reply('send me an image to host it on web')
@@ -55,15 +107,7 @@ async def handle_message(evt: events.NewMessage.Event) -> None:
             await evt.delete()
         return
     if str(evt.message.message).startswith('/del') and evt.reply_to_msg_id is not None:
-        if bool(int(evt.is_channel)) and bool(int(evt.is_group)):
-            peer = InputPeerChat(chat_id=int(evt.chat_id))
-        else:
-            if bool(int(evt.is_group)):
-                peer = InputPeerChat(chat_id=int(evt.chat_id))
-            elif bool(int(evt.is_channel)):
-                peer = InputPeerChannel(channel_id=int(evt.chat_id), access_hash=0)
-            else:
-                peer = InputPeerUser(user_id=int(evt.chat_id), access_hash=0)
+        peer = peers.resolve(await evt.get_input_chat())
         c = cast(Message, await client.get_messages(entity=peer, ids=evt.reply_to_msg_id))
         me = await client.get_me()
         reply_msg = cast(Message, await c.get_reply_message())
@@ -72,6 +116,7 @@ async def handle_message(evt: events.NewMessage.Event) -> None:
         if c.from_id == evt.from_id or (c.from_id == me.id and c.is_reply):
             if (reply_msg is not None and reply_msg.from_id == evt.from_id) or reply_msg is None:
                 await client.delete_messages(evt.input_chat, [evt.reply_to_msg_id])
+                meta_cache.invalidate(peer, evt.reply_to_msg_id)
         await evt.delete()
     else:
         if not evt.file:
@@ -81,8 +126,8 @@ async def handle_message(evt: events.NewMessage.Event) -> None:
         try:
             ret = get_media_meta(evt.media)
             if ret[0] and ret[1] and ret[2] <= max_file_size:
-                middle_x = StringCoder.encode(
-                    f"{evt.chat_id}|{evt.id}|{1 if evt.is_group else 0}|{1 if evt.is_channel else 0}")
+                middle_x = await make_link_id(evt)
+                meta_cache.add(evt.message)
                 log.debug(f"{evt.chat_id}|{evt.id}|{1 if evt.is_group else 0}|{1 if evt.is_channel else 0}")
                 # url = public_url / str(pack_id(evt)) / get_file_name(evt)
                 url = link_prefix / middle_x / get_file_name(evt)
@@ -91,8 +136,8 @@ async def handle_message(evt: events.NewMessage.Event) -> None:
             else:
                 if admin_id == evt.from_id and ret[0]:
                     log.debug('admin usage')
-                    middle_x = StringCoder.encode(
-                        f"{evt.chat_id}|{evt.id}|{1 if evt.is_group else 0}|{1 if evt.is_channel else 0}")
+                    middle_x = await make_link_id(evt)
+                    meta_cache.add(evt.message)
                     log.debug(f"{evt.chat_id}|{evt.id}|{1 if evt.is_group else 0}|{1 if evt.is_channel else 0}")
                     # url = public_url / str(pack_id(evt)) / get_file_name(evt)
                     url = link_prefix / middle_x / get_file_name(evt)
@@ -104,3 +149,9 @@ async def handle_message(evt: events.NewMessage.Event) -> None:
         except Exception as exp:
             await evt.reply(str(exp))
             pass
+
+
+if worker_index:
+    # Only the main process handles bot updates, the workers just serve files
+    for callback, event in client.list_event_handlers():
+        client.remove_event_handler(callback, event)
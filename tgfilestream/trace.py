@@ -0,0 +1,239 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from typing import (Any, Awaitable, Callable, ContextManager, Deque, Dict, Iterator, List,
+                    NamedTuple, Optional, Set)
+
+import aiohttp
+from aiohttp import web
+
+from .config import slow_request_threshold, slow_request_log_size, trace_export_url
+
+log = logging.getLogger(__name__)
+
+# Only this many spans are kept per trace, and spans shorter than min_span only count towards
+# the totals, so long downloads don't grow their traces without bound
+max_spans = 256
+min_span = 0.001
+service_name = 'tgfilestream'
+export_timeout = 10
+
+Handler = Callable[..., Awaitable[web.StreamResponse]]
+
+
+class Span(NamedTuple):
+    name: str
+    # Seconds since the start of the trace
+    start: float
+    duration: float
+    attrs: Dict[str, Any]
+
+
+def _span_id() -> str:
+    return f'{random.getrandbits(64):016x}'
+
+
+# The timings of one HTTP request. The trace is kept in a context variable, which the tasks
+# started for the request inherit, so their spans end up in it too.
+class Trace:
+    trace_id: str
+    name: str
+    # Wall clock time of the start of the request
+    started: float
+    duration: float
+    attrs: Dict[str, Any]
+    spans: List[Span]
+    # The number and total duration of each kind of span, including the ones that weren't kept
+    totals: Dict[str, List[float]]
+    dropped: int
+    finished: bool
+
+    _start: float
+
+    def __init__(self, name: str) -> None:
+        self.trace_id = _span_id()
+        self.name = name
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.duration = 0
+        self.attrs = {}
+        self.spans = []
+        self.totals = {}
+        self.dropped = 0
+        self.finished = False
+
+    def add(self, name: str, start: float, end: float, attrs: Dict[str, Any],
+            keep: bool = True) -> None:
+        if self.finished:
+            # Shared fetches can outlive the request that started them
+            return
+        total = self.totals.setdefault(name, [0, 0.0])
+        total[0] += 1
+        total[1] += end - start
+        if not keep or end - start < min_span:
+            return
+        if len(self.spans) < max_spans:
+            self.spans.append(Span(name, start - self._start, end - start, attrs))
+        else:
+            self.dropped += 1
+
+    def finish(self) -> None:
+        self.duration = time.monotonic() - self._start
+        self.finished = True
+
+    def summary(self) -> str:
+        totals = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+        return ', '.join(f'{name} {seconds:.3f}s/{count:.0f}' for name, (count, seconds) in totals)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started': self.started,
+            'duration': round(self.duration, 6),
+            'attrs': self.attrs,
+            'totals': {name: {'count': count, 'seconds': round(seconds, 6)}
+                       for name, (count, seconds) in self.totals.items()},
+            'spans': [{'name': span.name, 'start': round(span.start, 6),
+                       'duration': round(span.duration, 6), 'attrs': span.attrs}
+                      for span in self.spans],
+            'dropped_spans': self.dropped,
+        }
+
+    def to_zipkin(self) -> List[Dict[str, Any]]:
+        endpoint = {'serviceName': service_name}
+        started = int(self.started * 1_000_000)
+        tags = {key: str(value) for key, value in self.attrs.items()}
+        for name, (count, seconds) in self.totals.items():
+            tags[f'total.{name}'] = f'{seconds:.6f}s/{count:.0f}'
+        spans = [{'traceId': self.trace_id, 'id': self.trace_id, 'kind': 'SERVER',
+                  'name': self.name, 'timestamp': started,
+                  'duration': max(int(self.duration * 1_000_000), 1),
+                  'localEndpoint': endpoint, 'tags': tags}]
+        for span in self.spans:
+            spans.append({'traceId': self.trace_id, 'parentId': self.trace_id, 'id': _span_id(),
+                          'name': span.name,
+                          'timestamp': started + int(span.start * 1_000_000),
+                          'duration': max(int(span.duration * 1_000_000), 1),
+                          'localEndpoint': endpoint,
+                          'tags': {key: str(value) for key, value in span.attrs.items()}})
+        return spans
+
+
+# Keeps the traces of the most recent slow requests for the debug route, and sends them to the
+# trace collector if there is one
+class SlowRequests:
+    threshold: float
+    traces: Deque[Trace]
+
+    _exports: Set[asyncio.Future]
+
+    def __init__(self, threshold: float, size: int) -> None:
+        self.threshold = threshold
+        self.traces = deque(maxlen=size)
+        self._exports = set()
+
+    def keep(self, trace: Trace) -> None:
+        if trace.duration < self.threshold:
+            return
+        self.traces.append(trace)
+        log.info(f'Slow request {trace.trace_id}: {trace.name} took {trace.duration:.3f}s'
+                 f' ({trace.summary()})')
+        if trace_export_url:
+            task = asyncio.ensure_future(self._export(trace))
+            self._exports.add(task)
+            task.add_done_callback(self._exports.discard)
+
+    @staticmethod
+    async def _export(trace: Trace) -> None:
+        try:
+            async with aiohttp.request('POST', trace_export_url, json=trace.to_zipkin(),
+                                       timeout=aiohttp.ClientTimeout(total=export_timeout)
+                                       ) as resp:
+                if resp.status >= 300:
+                    log.warning(f'Trace collector rejected trace {trace.trace_id}'
+                                f' with HTTP {resp.status}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning(f'Failed to export trace {trace.trace_id}: {e!r}')
+
+
+current: 'ContextVar[Optional[Trace]]' = ContextVar('tgfilestream_trace', default=None)
+slow_requests = SlowRequests(slow_request_threshold, slow_request_log_size)
+no_span = nullcontext()
+
+
+# Everything below returns right away outside traced requests, which is always the case when
+# tracing is off
+def record(name: str, start: float, **attrs: Any) -> None:
+    trace = current.get()
+    if trace:
+        trace.add(name, start, time.monotonic(), attrs)
+
+
+@contextmanager
+def _span(trace: Trace, name: str, attrs: Dict[str, Any], keep: bool) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.monotonic(), attrs, keep)
+
+
+def span(name: str, **attrs: Any) -> ContextManager[None]:
+    trace = current.get()
+    return _span(trace, name, attrs, True) if trace else no_span
+
+
+# Like span, but only counted in the totals, for things that happen for every chunk
+def timed(name: str) -> ContextManager[None]:
+    trace = current.get()
+    return _span(trace, name, {}, False) if trace else no_span
+
+
+def annotate(**attrs: Any) -> None:
+    trace = current.get()
+    if trace:
+        trace.attrs.update(attrs)
+
+
+def traced(handler: Handler) -> Handler:
+    if not slow_request_threshold:
+        return handler
+
+    @wraps(handler)
+    async def wrapper(req: web.Request, *args: Any, **kwargs: Any) -> web.StreamResponse:
+        trace = Trace(f'{req.method} {req.path}')
+        token = current.set(trace)
+        try:
+            resp = await handler(req, *args, **kwargs)
+            trace.attrs['status'] = resp.status
+            return resp
+        except BaseException as e:
+            trace.attrs['error'] = type(e).__name__
+            raise
+        finally:
+            current.reset(token)
+            trace.finish()
+            slow_requests.keep(trace)
+
+    return wrapper
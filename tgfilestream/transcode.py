@@ -0,0 +1,239 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import bisect
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+from async_generator import aclosing
+
+from .config import (transcode_workers, transcode_cache_size, transcode_max_size, transcode_quality,
+                     transcode_queue, workers)
+from .diskcache import DiskPartCache
+from .memcache import MemoryPartCache
+from .metacache import FileMeta
+from . import metrics, trace
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# The formats images can be converted to, by query parameter name, in order of preference when
+# they're picked from the Accept header
+output_formats: Dict[str, Tuple[str, str]] = {
+    'avif': ('AVIF', 'image/avif'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+accept_formats = ['avif', 'webp']
+# Animated and vector images are served as they are
+source_types = {'image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'image/tiff'}
+# Images are only ever scaled down, to the smallest of these widths that is at least the one
+# asked for. Every width is converted and cached separately, so there are only a few of them.
+widths = [64, 128, 256, 512, 768, 1024, 1280, 1600, 1920, 2560, 3840]
+
+Body = Callable[[FileMeta, int, int], AsyncGenerator[bytes, None]]
+
+
+def convert(data: bytes, pil_format: str, width: int, quality: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        if width and image.width > width:
+            image = image.resize((width, max(round(image.height * width / image.width), 1)),
+                                 Image.LANCZOS)
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, pil_format, quality=quality)
+        return out.getvalue()
+
+
+def available_formats() -> List[str]:
+    if not Image:
+        return []
+    Image.init()
+    return [name for name, (pil_format, _) in output_formats.items() if pil_format in Image.SAVE]
+
+
+def parse_accept(accept: str) -> Dict[str, float]:
+    types = {}
+    for item in accept.split(','):
+        mime_type, *params = item.strip().split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        types[mime_type.strip().lower()] = quality
+    return types
+
+
+# Converts and resizes images in a process pool, keeping the results in their own memory cache
+# and the disk part cache
+class Transcoder:
+    loop: asyncio.AbstractEventLoop
+    formats: List[str]
+    cache: MemoryPartCache
+    disk_cache: Optional[DiskPartCache]
+
+    _pool: Optional[ProcessPoolExecutor]
+    _converting: int
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 disk_cache: Optional[DiskPartCache] = None) -> None:
+        self.loop = loop
+        self.formats = available_formats()
+        self.cache = MemoryPartCache(transcode_cache_size // workers, loop)
+        self.disk_cache = disk_cache
+        self._pool = None
+        self._converting = 0
+        if not self.formats:
+            log.warning('TRANSCODE_IMAGES is set, but Pillow is not installed')
+            return
+        # The workers are forked right away, while this process has no threads or connections
+        # yet. Spawned workers would re-run the main script instead.
+        self._pool = ProcessPoolExecutor(transcode_workers,
+                                         mp_context=multiprocessing.get_context('fork'))
+        self._pool.submit(int)
+
+    def applies(self, meta: FileMeta) -> bool:
+        return bool(self.formats) and meta.data is None and meta.mime_type in source_types \
+            and meta.size <= transcode_max_size
+
+    def negotiate(self, meta: FileMeta, query_format: Optional[str], accept: str
+                  ) -> Optional[str]:
+        if query_format:
+            return query_format if query_format in self.formats else None
+        accepted = parse_accept(accept)
+        for name in accept_formats:
+            mime_type = output_formats[name][1]
+            if name in self.formats and accepted.get(mime_type, 0) > 0:
+                return None if mime_type == meta.mime_type else name
+        return None
+
+    @staticmethod
+    def _cache_key(meta: FileMeta, name: str, width: int) -> str:
+        thumb = f'_{meta.thumb_size}' if meta.thumb_size else ''
+        return f'img{meta.file_id}{thumb}_{name}_{width}'
+
+    @classmethod
+    def _target(cls, meta: FileMeta, name: Optional[str], width: int) -> Tuple[str, int, str]:
+        # Resized images keep their format, unless it's one Pillow can only read
+        name = name or next((name for name, (_, mime_type) in output_formats.items()
+                             if mime_type == meta.mime_type), 'jpeg')
+        width = widths[min(bisect.bisect_left(widths, width), len(widths) - 1)] if width > 0 else 0
+        return name, width, cls._cache_key(meta, name, width)
+
+    @staticmethod
+    def _variant(meta: FileMeta, name: str, width: int, data: bytes) -> Optional[FileMeta]:
+        if not width and len(data) >= meta.size:
+            # Converting didn't make the image any smaller
+            return None
+        return replace(meta, size=len(data), mime_type=output_formats[name][1], data=data,
+                       transform=f'{name}{width or ""}')
+
+    async def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_cache or not self.disk_cache.contains(key, 0):
+            return None
+        data = await self.disk_cache.read(key, 0)
+        if data is None:
+            return None
+        metrics.cache_lookups.labels('transcode_disk', 'hit').inc()
+        # Converted images are kept in memory, so there's no point in keeping the file mapped
+        return bytes(data)
+
+    async def _load(self, meta: FileMeta, name: str, width: int, key: str, body: Body
+                    ) -> List[bytes]:
+        data = await self._read_disk(key)
+        if data is not None:
+            return [data]
+        source = bytearray()
+        async with aclosing(body(meta, 0, meta.size)) as chunks:
+            async for chunk in chunks:
+                source += chunk
+        if len(source) != meta.size:
+            raise ValueError(f'Got {len(source)} bytes of a {meta.size} byte image')
+        with trace.span('convert', format=name, width=width):
+            data = await self.loop.run_in_executor(self._pool, convert, bytes(source),
+                                                   output_formats[name][0], width,
+                                                   transcode_quality)
+        if self.disk_cache:
+            self.disk_cache.write(key, 0, data)
+        return [data]
+
+    def _converted(self, _: asyncio.Future) -> None:
+        self._converting -= 1
+
+    async def get(self, meta: FileMeta, name: Optional[str], width: int, body: Body
+                  ) -> Optional[FileMeta]:
+        name, width, key = self._target(meta, name, width)
+        data = self.cache.get(key, 0)
+        if data is not None:
+            metrics.cache_lookups.labels('transcode', 'hit').inc()
+        else:
+            future = self.cache.pending(key, 0)
+            if future:
+                metrics.cache_lookups.labels('transcode', 'coalesced').inc()
+            elif self._converting >= transcode_queue and not (
+                    self.disk_cache and self.disk_cache.contains(key, 0)):
+                # Conversions keep going after their clients leave, so their number is bounded
+                # instead of letting them pile up in the pool
+                metrics.cache_lookups.labels('transcode', 'overloaded').inc()
+                log.debug(f'{self._converting} images are being converted, serving the original'
+                          f' instead of {key}')
+                return None
+            else:
+                metrics.cache_lookups.labels('transcode', 'miss').inc()
+                future, = self.cache.load(key, [0],
+                                          lambda: self._load(meta, name, width, key, body))
+                self._converting += 1
+                future.add_done_callback(self._converted)
+            try:
+                # Shielded so one client going away doesn't cancel the conversion for the others
+                data = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Pillow raises all kinds of errors for images it can't read
+                log.debug(f'Failed to transcode {key}, serving the original', exc_info=True)
+                return None
+        return self._variant(meta, name, width, data)
+
+    # The converted image if it's already in memory or on disk, without converting it
+    async def cached(self, meta: FileMeta, name: Optional[str], width: int
+                     ) -> Optional[FileMeta]:
+        name, width, key = self._target(meta, name, width)
+        data = self.cache.get(key, 0)
+        if data is None:
+            data = await self._read_disk(key)
+            if data is None:
+                return None
+            self.cache.put(key, 0, data)
+        return self._variant(meta, name, width, data)
+
+    def stop(self) -> None:
+        if self._pool:
+            self._pool.shutdown()
@@ -19,7 +19,7 @@ from telethon.tl.custom import Message
 from telethon.tl.types import TypeInputPeer, InputPeerChannel, InputPeerChat, InputPeerUser
 from aiohttp import web
 
-from .config import trust_headers
+from .config import trust_headers, trusted_proxy_count
 
 pack_bits = 32
 pack_bit_mask = (1 << pack_bits) - 1
@@ -65,9 +65,13 @@ def get_file_name(message: Union[Message, events.NewMessage.Event]) -> str:
 def get_requester_ip(req: web.Request) -> str:
     if trust_headers:
         try:
-            return req.headers['X-Forwarded-For']
+            chain = [ip.strip() for ip in req.headers['X-Forwarded-For'].split(',') if ip.strip()]
         except KeyError:
-            pass
+            chain = []
+        if chain:
+            # Each trusted proxy appends the address it received the request from, anything
+            # before those was sent by the client and can't be trusted
+            return chain[max(len(chain) - trusted_proxy_count, 0)]
     peername = req.transport.get_extra_info('peername')
     if peername is not None:
         return peername[0]
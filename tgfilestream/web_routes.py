@@ -13,41 +13,52 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import base64
 import logging
-from collections import defaultdict
-from typing import Dict, cast
+import uuid
+from typing import AsyncGenerator, Callable, List, Optional
 
 from aiohttp import web
-from telethon.tl.custom import Message
-from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+from async_generator import aclosing
+from prometheus_client import CONTENT_TYPE_LATEST
+from telethon.errors import BadRequestError
 
-from .config import request_limit, web_api_key, show_index
-from .string_encoder import StringCoder
-from .telegram import client, transfer
-from .util import get_file_name, get_requester_ip
+from .config import (web_api_key, show_index, cache_control, enable_metrics,
+                     stream_write_timeout, upload_chat_id, transcode_images,
+                     slow_request_threshold)
+from .httputil import (ByteRange, RangeNotSatisfiable, content_range, http_date, is_not_modified,
+                       parse_range, range_applies)
+from .limiter import ClientLimiter
+from . import linkid
+from .metacache import FileMeta
+from .metrics import TransferCollector, route_name
+from .paralleltransfer import is_file_reference_error, max_upload_size
+from . import metrics, trace
+from .telegram import client, transfer, meta_cache, peers, client_ready, make_link, send_upload
+from .transcode import Transcoder
+from .util import get_requester_ip
 
 log = logging.getLogger(__name__)
 routes = web.RouteTableDef()
-ongoing_requests: Dict[str, int] = defaultdict(lambda: 0)
+# How long requests that arrive during startup wait for the client before getting a 503
+max_startup_wait = 30
+limiter = ClientLimiter()
+transcoder = Transcoder(transfer.loop, transfer.disk_cache) if transcode_images else None
+if enable_metrics:
+    TransferCollector(transfer, limiter).register()
 
 
-def extract_peer(encrypt_str: str):
-    try:
-        chat_id, msg_id, is_group, is_channel = StringCoder.decode(encrypt_str).split('|')
-        if bool(int(is_channel)) and bool(int(is_group)):
-            peer = InputPeerChat(chat_id=int(chat_id))
-        else:
-            if bool(int(is_group)):
-                peer = InputPeerChat(chat_id=int(chat_id))
-            elif bool(int(is_channel)):
-                peer = InputPeerChannel(channel_id=int(chat_id), access_hash=0)
-            else:
-                peer = InputPeerUser(user_id=int(chat_id), access_hash=0)
-        return peer, msg_id
-    except Exception as ep:
-        log.debug(ep)
-        return None, None
+# The HTTP server starts listening before the client has logged in, requests wait until it has
+@web.middleware
+async def ready_middleware(req: web.Request, handler: Callable) -> web.StreamResponse:
+    if not client_ready.is_set() and route_name(req) != '/metrics':
+        try:
+            await asyncio.wait_for(client_ready.wait(), max_startup_wait)
+        except asyncio.TimeoutError:
+            return web.Response(status=503, text='503: Service is starting up',
+                                headers={'Retry-After': '5'})
+    return await handler(req)
 
 
 @routes.get(r'')
@@ -69,6 +80,28 @@ async def favicon(req: web.Request) -> web.Response:
                         )
 
 
+@routes.get(r'/metrics')
+async def metrics_route(req: web.Request) -> web.Response:
+    if not enable_metrics:
+        return web.Response(status=404, text='<h3>404 Not Found</h3>', content_type='text/html')
+    return web.Response(status=200, body=metrics.generate(),
+                        headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+@routes.get(r'/debug/traces')
+async def debug_traces(req: web.Request) -> web.Response:
+    check_key = req.headers.get('WEB_API_KEY')
+    if check_key is None or check_key != web_api_key:
+        return web.Response(status=401, text='<h3>401 Not Allowed</h3>', content_type='text/html')
+    if not slow_request_threshold:
+        return web.Response(status=404, text='<h3>404 Not Found</h3>', content_type='text/html')
+    traces = reversed(trace.slow_requests.traces)
+    if req.query.get('format') == 'zipkin':
+        return web.json_response([span for slow in traces for span in slow.to_zipkin()])
+    return web.json_response({'threshold': slow_request_threshold,
+                              'traces': [slow.to_dict() for slow in traces]})
+
+
 @routes.head(r'/{id:\S+}/{name}')
 async def handle_head_request(req: web.Request) -> web.Response:
     return await handle_request(req, head=True)
@@ -90,67 +123,240 @@ async def delete_image(req: web.Request) -> web.Response:
     check_key = req.headers.get('WEB_API_KEY')
     if check_key is None or check_key != web_api_key:
         return web.Response(status=401, text='<h3>401 Not Allowed</h3>', content_type='text/html')
-    peer, msg_id = extract_peer(file_id)
-    if not peer or not msg_id:
+    link = linkid.decode(file_id)
+    if not link or not link.msg_id:
         return web.Response(status=404, text='<h3>404 Not Found</h3>', content_type='text/html')
-    await client.delete_messages(peer, [msg_id])
+    await client.delete_messages(peers.resolve(link.peer), [link.msg_id])
+    meta_cache.invalidate(link.peer, link.msg_id)
     return web.Response(status=200, text=f'msg {file_id} deleted\r\n')
 
 
-def allow_request(ip: str) -> None:
-    return ongoing_requests[ip] < request_limit
+@routes.post(r'/upload/{name}')
+@trace.traced
+async def upload_file(req: web.Request) -> web.Response:
+    check_key = req.headers.get('WEB_API_KEY')
+    if check_key is None or check_key != web_api_key:
+        return web.Response(status=401, text='<h3>401 Not Allowed</h3>', content_type='text/html')
+    if not upload_chat_id:
+        return web.Response(status=404, text='<h3>404 Not Found</h3>', content_type='text/html')
+    size = req.content_length
+    if size is None:
+        # The part count of big files has to be known before the first part is sent
+        return web.Response(status=411, text='Content-Length is required\r\n')
+    if not 0 < size <= max_upload_size:
+        return web.Response(status=413, text=f'Uploads must be between 1 and {max_upload_size}'
+                                             ' bytes\r\n')
+    try:
+        file = await transfer.upload(req.content.readexactly, size, req.match_info['name'])
+    except asyncio.IncompleteReadError:
+        log.debug('Client disconnected during upload')
+        return web.Response(status=400, text='Request body ended early\r\n')
+    message = await send_upload(file)
+    meta_cache.add(message)
+    url = await make_link(message)
+    log.debug(f'Uploaded {size} bytes to {message.id} in {message.chat_id}: {url}')
+    return web.Response(status=200, text=f'{url}\r\n')
 
 
-def increment_counter(ip: str) -> None:
-    ongoing_requests[ip] += 1
+async def multipart_body(meta: FileMeta, ranges: List[ByteRange], boundary: str
+                         ) -> AsyncGenerator[bytes, None]:
+    for start, stop in ranges:
+        yield multipart_header(meta, boundary, start, stop)
+        async with aclosing(file_body(meta, start, stop)) as body:
+            async for chunk in body:
+                yield chunk
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode('utf-8')
 
 
-def decrement_counter(ip: str) -> None:
-    ongoing_requests[ip] -= 1
+async def inline_body(data: bytes) -> AsyncGenerator[bytes, None]:
+    yield data
+
+
+def file_body(meta: FileMeta, start: int, stop: int, retry: bool = True,
+              reader: Optional[str] = None) -> AsyncGenerator[bytes, None]:
+    if meta.data is not None:
+        # Stripped and cached thumbnails come with the message, there's nothing to download
+        return inline_body(meta.data[start:stop])
+    return download_body(meta, start, stop, retry, reader)
+
+
+async def download_body(meta: FileMeta, start: int, stop: int, retry: bool,
+                        reader: Optional[str] = None) -> AsyncGenerator[bytes, None]:
+    pos = start
+    try:
+        async with aclosing(transfer.download(meta.media, file_size=meta.size, offset=start,
+                                              limit=stop, thumb_size=meta.thumb_size,
+                                              reader=reader)) as body:
+            async for chunk in body:
+                pos += len(chunk)
+                yield chunk
+        return
+    except BadRequestError as e:
+        if not is_file_reference_error(e) or not retry:
+            raise
+        error = e
+    # Indexed files keep the file reference they were sent with until it stops working
+    fresh = await meta_cache.refresh(meta)
+    if not fresh:
+        log.info(f'The file in {meta.msg_id} (chat {meta.chat_id}) is gone, aborting the'
+                 f' download at byte {pos}')
+        raise error
+    async with aclosing(file_body(fresh, pos, stop, retry=False)) as body:
+        async for chunk in body:
+            yield chunk
 
 
+def multipart_header(meta: FileMeta, boundary: str, start: int, stop: int) -> bytes:
+    return (f'--{boundary}\r\n'
+            f'Content-Type: {meta.mime_type}\r\n'
+            f'Content-Range: {content_range(start, stop, meta.size)}\r\n\r\n').encode('utf-8')
+
+
+@trace.traced
 async def handle_request(req: web.Request, head: bool = False) -> web.Response:
     file_name = req.match_info['name']
     file_id = str(req.match_info['id'])
     dl = 'dl' in req.query.keys()
 
-    peer, msg_id = extract_peer(file_id)
-    if not peer or not msg_id:
-        ret = 'peer or msg_id None,file_id=%s,msg_id=%s\r\n' % (file_id, msg_id)
+    link = linkid.decode(file_id)
+    if not link or not link.msg_id:
+        ret = 'invalid link,file_id=%s\r\n' % file_id
         log.debug(ret)
         return web.Response(status=404, text='<h3>404 Not Found</h3>', content_type='text/html')
 
-    message = cast(Message, await client.get_messages(entity=peer, ids=int(msg_id)))
-    if not message or not message.file or get_file_name(message) != file_name:
+    with trace.span('meta'):
+        meta = await meta_cache.get(link.peer, link.msg_id)
+    if not meta or meta.name != file_name:
         ret = 'msg not found file_id=%s\r\n' % file_id
         log.debug(ret)
         return web.Response(status=404, text='<h3>404 Not Found</h3>', content_type='text/html')
+    thumb_size = req.query.get('size')
+    if thumb_size:
+        meta = meta.variant(thumb_size)
+        if not meta:
+            log.debug(f'No {thumb_size} size of file_id={file_id}')
+            return web.Response(status=404, text='<h3>404 Not Found</h3>',
+                                content_type='text/html')
+    vary_accept = False
+    slot = None
+    if transcoder and transcoder.applies(meta):
+        image_format = req.query.get('format')
+        # Without an explicit format, the Accept header decides whether the image is converted
+        vary_accept = not image_format
+        image_format = transcoder.negotiate(meta, image_format, req.headers.get('Accept', ''))
+        try:
+            width = int(req.query.get('w', '0'))
+        except ValueError:
+            width = 0
+        if image_format or width > 0:
+            with trace.span('transcode'):
+                if head:
+                    # HEAD requests never start a conversion. Until the image has been converted
+                    # for a GET, they describe the original.
+                    meta = await transcoder.cached(meta, image_format, width) or meta
+                else:
+                    # Converting downloads the whole image, so it holds one of the client's
+                    # streams like the download itself does
+                    slot = limiter.acquire(get_requester_ip(req))
+                    if not slot:
+                        return web.Response(status=429)
+                    try:
+                        meta = await transcoder.get(meta, image_format, width, file_body) or meta
+                    except BaseException:
+                        slot.release()
+                        raise
 
-    size = message.file.size
-    offset = req.http_range.start or 0
-    limit = req.http_range.stop or size
-
-    if not head:
-        ip = get_requester_ip(req)
-        if not allow_request(ip):
-            return web.Response(status=429)
-        log.debug(f'Serving file in {message.id} (chat {message.chat_id}) to {ip}')
-        body = transfer.download(message.media, file_size=size, offset=offset, limit=limit)
-    else:
-        body = None
-
+    size = meta.size
+    etag = meta.etag
+    last_modified = meta.date
     h = {
-        'Content-Type': message.file.mime_type,
-        'Content-Range': f'bytes {offset}-{size}/{size}',
-        'Content-Length': str(limit - offset),
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
         'Access-Control-Allow-Origin': '*',
         'content-security-policy': 'script-src "self" "unsafe-inline" "unsafe-eval"',
         # 'Content-Disposition': f'attachment; filename='{file_name}'',
         'Accept-Ranges': 'bytes',
     }
+    if cache_control:
+        h['Cache-Control'] = cache_control
+    if vary_accept:
+        h['Vary'] = 'Accept'
     if dl:
         h['Content-Disposition'] = f'attachment; filename="{file_name}"'
 
-    return web.Response(status=206 if offset else 200,
-                        body=body,
-                        headers=h)
+    if is_not_modified(req, etag, last_modified):
+        if slot:
+            slot.release()
+        return web.Response(status=304, headers=h)
+
+    try:
+        ranges = (parse_range(req.headers.get('Range'), size)
+                  if range_applies(req, etag, last_modified) else None)
+    except RangeNotSatisfiable:
+        h['Content-Range'] = f'bytes */{size}'
+        if slot:
+            slot.release()
+        return web.Response(status=416, headers=h)
+
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        h['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        length = sum(len(multipart_header(meta, boundary, start, stop)) + stop - start + 2
+                     for start, stop in ranges)
+        length += len(f'--{boundary}--\r\n')
+        status = 206
+    else:
+        offset, limit = ranges[0] if ranges else (0, size)
+        h['Content-Type'] = meta.mime_type
+        if ranges:
+            h['Content-Range'] = content_range(offset, limit, size)
+        length = limit - offset
+        status = 206 if ranges else 200
+    h['Content-Length'] = str(length)
+    trace.annotate(range=req.headers.get('Range', ''), length=length)
+
+    if not head:
+        ip = get_requester_ip(req)
+        slot = slot or limiter.acquire(ip)
+        if not slot:
+            return web.Response(status=429)
+        log.debug(f'Serving file in {meta.msg_id} (chat {meta.chat_id}) to {ip}')
+        if ranges and len(ranges) > 1:
+            body = multipart_body(meta, ranges, boundary)
+        else:
+            body = file_body(meta, offset, limit, reader=ip)
+        body = slot.wrap(metrics.count_bytes(body, route_name(req)))
+        return await stream_response(req, web.StreamResponse(status=status, headers=h), body)
+
+    return web.Response(status=status, headers=h)
+
+
+async def stream_response(req: web.Request, resp: web.StreamResponse,
+                          body: AsyncGenerator[bytes, None]) -> web.StreamResponse:
+    # Closing the body as soon as the client is gone cancels the parts that are still being
+    # fetched, which gives their pooled connections back right away
+    async with aclosing(body):
+        await resp.prepare(req)
+        try:
+            async for chunk in body:
+                # Writes wait for the socket to drain, so a slow client slows the download down
+                with trace.timed('write'):
+                    await asyncio.wait_for(resp.write(chunk), stream_write_timeout)
+        except asyncio.TimeoutError:
+            log.debug(f'Client stopped reading for {stream_write_timeout} seconds, aborting')
+            if req.transport:
+                req.transport.close()
+            return resp
+        except ConnectionResetError:
+            log.debug('Client disconnected during download')
+            return resp
+        except Exception:
+            # The status and length were already sent, so the client can only tell the body is
+            # incomplete if the connection is closed instead of ended normally
+            log.warning('Download failed, aborting the response', exc_info=True)
+            if req.transport:
+                req.transport.close()
+            return resp
+    await resp.write_eof()
+    return resp
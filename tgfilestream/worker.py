@@ -0,0 +1,90 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+import signal
+import sys
+
+from aiohttp import web
+
+from tgfilestream.config import host, port, worker_index
+from tgfilestream.log import log
+from tgfilestream.startup import timer
+from tgfilestream.telegram import client, transfer, client_ready
+from tgfilestream.metrics import metrics_middleware
+from tgfilestream.web_routes import routes, ready_middleware, transcoder
+
+server = web.Application(middlewares=[metrics_middleware, ready_middleware])
+server.add_routes(routes)
+runner = web.AppRunner(server)
+
+loop = asyncio.get_event_loop()
+parent_pid = os.getppid()
+
+
+async def watch_parent() -> None:
+    # Don't outlive the main process if it dies without stopping the workers
+    while os.getppid() == parent_pid:
+        await asyncio.sleep(5)
+    log.warning(f'Main process exited, stopping worker {worker_index}')
+    loop.stop()
+
+
+async def start() -> None:
+    timer.mark('imports')
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=True).start()
+    timer.mark('http')
+
+    # The main process has already logged in and fixed up the DC of the session
+    await client.connect()
+    timer.mark('connect')
+    transfer.post_init()
+    client_ready.set()
+    timer.mark('transfer')
+    timer.report()
+    loop.create_task(watch_parent())
+
+
+async def stop() -> None:
+    await runner.cleanup()
+    await transfer.stop()
+    if transcoder:
+        transcoder.stop()
+    await client.disconnect()
+
+
+if not worker_index:
+    print('The worker module is started by the main process when WORKERS is above 1')
+    sys.exit(1)
+
+try:
+    loop.run_until_complete(start())
+except Exception:
+    log.fatal(f'Failed to initialize worker {worker_index}', exc_info=True)
+    sys.exit(2)
+
+log.info(f'Worker {worker_index} initialization complete')
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+except Exception:
+    log.fatal('Fatal error in event loop', exc_info=True)
+    sys.exit(3)
+loop.run_until_complete(stop())
@@ -0,0 +1,116 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+from typing import Dict, Optional
+
+from prometheus_client import multiprocess
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+
+from .config import workers, metrics_dir, temporary_metrics_dir
+
+# How often the main process checks on the workers, in seconds
+supervise_interval = 5
+# How long workers get to shut down before they're killed, in seconds
+stop_timeout = 10
+
+log = logging.getLogger(__name__)
+
+
+# Workers use the authorization of the main process, but keep the rest of the session in memory
+# so the session database only has one writer
+def worker_session(filename: str) -> MemorySession:
+    conn = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+    try:
+        row = conn.execute('select dc_id, server_address, port, auth_key from sessions').fetchone()
+    finally:
+        conn.close()
+    if not row or not row[3]:
+        raise RuntimeError(f'{filename} has not been logged in by the main process')
+    session = MemorySession()
+    session.set_dc(row[0], row[1], row[2])
+    session.auth_key = AuthKey(row[3])
+    return session
+
+
+# Starts the worker processes from the main process and restarts them if they exit
+class WorkerPool:
+    loop: asyncio.AbstractEventLoop
+    processes: Dict[int, subprocess.Popen]
+
+    _supervisor: Optional[asyncio.Future]
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.processes = {}
+        self._supervisor = None
+
+    def _spawn(self, index: int) -> None:
+        env = dict(os.environ, WORKER_INDEX=str(index))
+        proc = subprocess.Popen([sys.executable, '-m', 'tgfilestream.worker'], env=env)
+        self.processes[index] = proc
+        log.info(f'Started worker {index} with PID {proc.pid}')
+
+    def start(self) -> None:
+        for index in range(1, workers):
+            self._spawn(index)
+        if self.processes:
+            self._supervisor = self.loop.create_task(self._supervise())
+
+    async def _supervise(self) -> None:
+        while True:
+            await asyncio.sleep(supervise_interval)
+            for index, proc in list(self.processes.items()):
+                code = proc.poll()
+                if code is not None:
+                    log.warning(f'Worker {index} exited with code {code}, restarting it')
+                    self._forget(proc)
+                    self._spawn(index)
+
+    @staticmethod
+    def _forget(proc: subprocess.Popen) -> None:
+        if metrics_dir:
+            # The live gauges of the process stop counting, its counters are kept
+            multiprocess.mark_process_dead(proc.pid, metrics_dir)
+
+    @staticmethod
+    def _wait(proc: subprocess.Popen) -> None:
+        try:
+            proc.wait(stop_timeout)
+        except subprocess.TimeoutExpired:
+            log.warning(f'Worker with PID {proc.pid} did not stop in time, killing it')
+            proc.kill()
+            proc.wait()
+
+    async def stop(self) -> None:
+        if self._supervisor:
+            self._supervisor.cancel()
+        for proc in self.processes.values():
+            if proc.poll() is None:
+                proc.terminate()
+        await asyncio.gather(*[self.loop.run_in_executor(None, self._wait, proc)
+                               for proc in self.processes.values()])
+        for proc in self.processes.values():
+            self._forget(proc)
+        self.processes = {}
+        if temporary_metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)